@@ -0,0 +1,251 @@
+"""
+Benchmark of the amix render pipeline with synthetic clips and definitions.
+
+Every stage (``Amix.create``, ``_load_clips``, ``_setup``, ``_create_mix`` and
+``_render_mix``) is timed separately and the results are written as JSON, so runs of
+different commits can be compared with ``--compare``.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import ffmpeg
+import yaml
+
+from amix import __version__
+from amix.amix import Amix
+
+STAGES = ["create", "load_clips", "setup", "create_mix", "render_mix"]
+
+
+def parse_args(args):
+    """
+    Parse command line parameters
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the amix render pipeline")
+    parser.add_argument("--clips", help="Number of clips", type=int, default=8)
+    parser.add_argument("--parts", help="Number of parts", type=int, default=8)
+    parser.add_argument("--segments", help="Number of segments", type=int, default=4)
+    parser.add_argument(
+        "--clips_per_part", help="Number of clips per part", type=int, default=3
+    )
+    parser.add_argument(
+        "--parts_per_segment", help="Number of parts per segment", type=int, default=2
+    )
+    parser.add_argument(
+        "--bars", help="Bars of every part and segment", type=int, default=16
+    )
+    parser.add_argument(
+        "--loop", help="Loop count set on every clip reference", type=int
+    )
+    parser.add_argument(
+        "--pitch",
+        help="Share of parts with a pitch filter, between 0 and 1",
+        type=float,
+        default=0,
+    )
+    parser.add_argument("--tempo", help="Original tempo", type=float, default=180)
+    parser.add_argument("--repeat", help="Number of runs", type=int, default=3)
+    parser.add_argument("--seed", help="Random seed", type=int, default=0)
+    parser.add_argument("--jobs", help="Amix jobs", type=int, default=1)
+    parser.add_argument(
+        "--engine", help="Amix engine", choices=["ffmpeg", "numpy"], default="ffmpeg"
+    )
+    parser.add_argument(
+        "--single_graph", help="Render with a single graph", action="store_true"
+    )
+    parser.add_argument(
+        "--cache", help="Use the render and probe caches", action="store_true"
+    )
+    parser.add_argument("--workdir", help="Directory for clips and renders")
+    parser.add_argument("-o", "--output", help="JSON result file, default stdout")
+    parser.add_argument("--compare", help="JSON result file to compare against")
+    return parser.parse_args(args)
+
+
+def generate(args, workdir):
+    """
+    Generates clips and a definition file, returns the definition path.
+    """
+    rng = random.Random(args.seed)
+    bar_time = 60 / args.tempo * 4
+    clips_dir = os.path.join(workdir, "clips")
+    os.makedirs(clips_dir, exist_ok=True)
+
+    clips = []
+    for i in range(args.clips):
+        name = "clip{0}".format(i)
+        path = os.path.join(clips_dir, name + ".wav")
+        clips.append({"name": name, "path": path})
+        if os.path.exists(path):
+            continue
+        duration = rng.choice([1, 2, 4]) * bar_time
+        ffmpeg.input(
+            "sine=frequency={0}:sample_rate=44100:duration={1}".format(
+                rng.randint(110, 880), duration
+            ),
+            format="lavfi",
+        ).output(path, ac=2, loglevel="error").run(overwrite_output=True)
+
+    filters = [{"name": "pitch", "type": "pitch", "pitch": 0.9}]
+    parts = []
+    for i in range(args.parts):
+        part = {
+            "name": "part{0}".format(i),
+            "bars": args.bars,
+            "clips": [
+                {"name": c["name"]}
+                for c in rng.sample(clips, min(args.clips_per_part, len(clips)))
+            ],
+        }
+        if args.loop:
+            for c in part["clips"]:
+                c["loop"] = args.loop
+        if rng.random() < args.pitch:
+            part["filters"] = [{"name": "pitch"}]
+        parts.append(part)
+
+    mix = []
+    for i in range(args.segments):
+        mix.append(
+            {
+                "name": "segment{0}".format(i),
+                "parts": [
+                    {"name": p["name"]}
+                    for p in rng.sample(parts, min(args.parts_per_segment, len(parts)))
+                ],
+            }
+        )
+
+    definition = os.path.join(workdir, "benchmark.yml")
+    with open(definition, "w") as f:
+        yaml.dump(
+            {
+                "name": "benchmark",
+                "original_tempo": args.tempo,
+                "bars": args.bars,
+                "clips": clips,
+                "filters": filters,
+                "parts": parts,
+                "mix": mix,
+            },
+            f,
+        )
+    return definition
+
+
+def timed(timings, stage, fn):
+    start = time.perf_counter()
+    result = fn()
+    timings[stage] = time.perf_counter() - start
+    return result
+
+
+def run_once(args, definition, workdir):
+    """
+    Runs the pipeline once, returns the time of every stage in seconds.
+    """
+    output = os.path.join(workdir, "output")
+    shutil.rmtree(output, ignore_errors=True)
+    timings = {}
+    a = timed(
+        timings,
+        "create",
+        lambda: Amix.create(
+            definition,
+            output,
+            True,
+            clip=[],
+            jobs=args.jobs,
+            cache=args.cache,
+            cache_dir=os.path.join(workdir, "cache"),
+            single_graph=args.single_graph,
+            engine=args.engine,
+        ),
+    )
+    timed(timings, "load_clips", a._load_clips)
+    # the clips are loaded already, so _setup only prepares and renders parts
+    load_clips = a._load_clips
+    a._load_clips = lambda: None
+    timed(timings, "setup", a._setup)
+    a._load_clips = load_clips
+    timed(timings, "create_mix", a._create_mix)
+    timed(timings, "render_mix", a._render_mix)
+    a._cleanup()
+    timings["total"] = sum(timings.values())
+    return timings
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(result, baseline):
+    """
+    Prints the ratio of median stage times against a baseline result.
+    """
+    for stage in STAGES + ["total"]:
+        new = result["median"][stage]
+        old = baseline["median"][stage]
+        print(
+            "{0:<12} {1:>10.4f}s {2:>10.4f}s {3:>8.2f}x".format(
+                stage, old, new, new / old if old else float("nan")
+            ),
+            file=sys.stderr,
+        )
+
+
+def main(args):
+    args = parse_args(args)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="amix-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    definition = generate(args, workdir)
+
+    runs = [run_once(args, definition, workdir) for _ in range(args.repeat)]
+    result = {
+        "version": __version__,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "parameters": {
+            k: v
+            for k, v in vars(args).items()
+            if k not in ("workdir", "output", "compare")
+        },
+        "runs": runs,
+        "min": {k: min([r[k] for r in runs]) for k in runs[0]},
+        "median": {k: sorted([r[k] for r in runs])[len(runs) // 2] for k in runs[0]},
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,31 +1,277 @@
-import glob
+import asyncio
+import functools
+import hashlib
 import json
 import logging
 import math
 import os
-import random
 import shutil
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import ffmpeg
-import jsonschema
-import yaml
-from jinja2 import Template
+
+from .cache import ProbeCache, RenderCache, default_cache_dir
+from .library import discover
+from .trace import Tracer
 
 _logger = logging.getLogger(__name__)
 
+# format and rubberband settings of preview renders
+_PREVIEW_SAMPLE_RATE = 22050
+_PREVIEW_CHANNELS = 1
+_PREVIEW_RUBBERBAND = dict(transients="smooth", window="short", pitchq="speed")
+
+
+def _fan_out(streams):
+    """
+    Rebuilds the filter graph of streams with an asplit filter wherever a filter
+    output is consumed more than once. ffmpeg-python merges identical nodes, so
+    shared subgraphs, like a part used in several segments, end up as fan-outs.
+    """
+
+    nodes, outgoing_edge_maps = ffmpeg.dag.topo_sort([s.node for s in streams])
+    uses = {}
+    for s in streams:
+        uses[(s.node, s.label)] = uses.get((s.node, s.label), 0) + 1
+
+    available = {}
+
+    def take(edge):
+        if isinstance(edge.upstream_node, ffmpeg.nodes.InputNode):
+            return edge.upstream_node.stream(
+                edge.upstream_label, edge.upstream_selector
+            )
+        return available[(edge.upstream_node, edge.upstream_label)].pop(0)
+
+    for node in nodes:
+        if isinstance(node, ffmpeg.nodes.InputNode):
+            continue
+        new_node = ffmpeg.nodes.FilterNode(
+            [take(edge) for edge in node.incoming_edges],
+            node.name,
+            max_inputs=None,
+            args=node.args,
+            kwargs=node.kwargs,
+        )
+        counts = {}
+        for label, downstreams in outgoing_edge_maps.get(node, {}).items():
+            counts[label] = len(downstreams)
+        for (n, label), count in uses.items():
+            if n == node:
+                counts[label] = counts.get(label, 0) + count
+        for label, count in counts.items():
+            stream = new_node.stream(label)
+            if count > 1:
+                split = stream.filter_multi_output("asplit")
+                available[(node, label)] = [split.stream(i) for i in range(count)]
+            else:
+                available[(node, label)] = [stream]
+
+    return [
+        s
+        if isinstance(s.node, ffmpeg.nodes.InputNode)
+        else available[(s.node, s.label)].pop(0)
+        for s in streams
+    ]
+
+
+def _identity_filter(filter_type, kwargs):
+    """
+    Returns whether a resolved filter leaves the audio unchanged.
+    """
+
+    if filter_type == "volume":
+        return kwargs["volume"] == 1
+    elif filter_type == "rubberband":
+        return kwargs["pitch"] == 1 and kwargs["tempo"] == 1
+    elif filter_type == "afade":
+        # even without a curve, afade silences before a fade in starts and
+        # after a fade out ends
+        return (
+            kwargs["curve"] == "nofade"
+            and kwargs["type"] == "in"
+            and kwargs["start_time"] == 0
+            and kwargs.get("enable") == None
+        )
+    return False
+
+
+def _optimize_filters(chain):
+    """
+    Drops identity filters from a chain of resolved filters, and folds
+    consecutive volume filters with the same enable window into one.
+    """
+
+    optimized = []
+    for filter_type, kwargs in chain:
+        if (
+            filter_type == "volume"
+            and len(optimized) > 0
+            and optimized[-1][0] == "volume"
+            and optimized[-1][1].get("enable") == kwargs.get("enable")
+        ):
+            previous = optimized.pop()[1]
+            kwargs = dict(kwargs, volume=previous["volume"] * kwargs["volume"])
+        if not _identity_filter(filter_type, kwargs):
+            optimized.append((filter_type, kwargs))
+    return optimized
+
+
+def _wav_format(f):
+    """
+    Returns the fmt chunk of a WAV file, or None if it isn't one.
+    """
+
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WAVE":
+        return None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        size = struct.unpack("<I", chunk[4:])[0]
+        if chunk[:4] == b"fmt ":
+            return f.read(size)
+        f.seek(size + size % 2, os.SEEK_CUR)
+
+
+@functools.lru_cache(maxsize=None)
+def _validator():
+    """
+    Returns the validator of the amix definition schema, checked and compiled once.
+    """
+    import jsonschema
+
+    with open(os.path.join(os.path.dirname(__file__), "amix.json")) as f:
+        schema = json.load(f)
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def _engine(name, transport="file"):
+    """
+    Returns the Amix class implementing an engine and intermediate transport.
+    """
+
+    if transport not in ("file", "pipe"):
+        raise Exception('Transport "{0}" does not exist'.format(transport))
+    if name == "numpy":
+        from .numpy_engine import NumpyAmix
+
+        # samples are always passed in memory
+        return NumpyAmix
+    elif name == "ffmpeg":
+        if transport == "pipe":
+            from .pipe_transport import PipeAmix
+
+            return PipeAmix
+        return Amix
+    raise Exception('Engine "{0}" does not exist'.format(name))
+
 
 class _Clip:
     def __init__(self, name, path):
         self.name = name
         self.path = path
+        self.lock = threading.Lock()
+        self.decoded = {}
+        self.samples = None
+        self.samples_extension = None
+        self.buffers = {}
+        self.probe_lock = threading.Lock()
+        self.probe_cache = None
+        self.prober = ffmpeg.probe
+        self.probed = None
+        self.loaded = None
+        self.hoisted = {}
 
-    def load(self):
+    def load(self, probe_cache=None, probe=ffmpeg.probe):
         file = os.path.realpath(self.path)
         _logger.info('Loading clip "{0}" from "{1}"'.format(self.name, self.path))
         self.input = ffmpeg.input(file)
-        self.probe = ffmpeg.probe(file)["streams"][0]
-        _logger.debug('Probe for clip "{0}" is "{1}"'.format(self.name, self.probe))
+        self.decoded = {}
+        self.samples = None
+        self.samples_extension = None
+        self.buffers = {}
+        self.hoisted = {}
+        self.loaded = self.identity()
+        # probed on first use, in parallel by Amix._load_clips
+        self.probe_cache = probe_cache
+        self.prober = probe
+        self.probed = None
+
+    @property
+    def probe(self):
+        with self.probe_lock:
+            if self.probed == None:
+                file = os.path.realpath(self.path)
+                if self.probe_cache != None:
+                    self.probed = self.probe_cache.probe(file, self.prober)
+                else:
+                    self.probed = self.prober(file)["streams"][0]
+                _logger.debug(
+                    'Probe for clip "{0}" is "{1}"'.format(self.name, self.probed)
+                )
+        return self.probed
+
+    def filename(self, dirname, extension):
+        return os.path.join(
+            dirname,
+            "{0}.{1}".format(
+                hashlib.sha1(os.path.realpath(self.path).encode("utf-8")).hexdigest(),
+                extension,
+            ),
+        )
+
+    def decode(self, dirname, loglevel, extension="wav", run=None, **kwargs):
+        with self.lock:
+            if extension not in self.decoded:
+                filename = self.filename(dirname, extension)
+                _logger.info('Decoding clip "{0}" to "{1}"'.format(self.name, filename))
+                stream = self.input.output(filename, loglevel=loglevel, **kwargs)
+                if run != None:
+                    run(stream, overwrite_output=True)
+                else:
+                    stream.run(overwrite_output=True)
+                self.decoded[extension] = filename
+        return self.decoded[extension]
+
+    def pcm(self, dirname, loglevel, sample_rate, channels, run=None):
+        """
+        Decodes the clip once to raw float samples, memory mapped read-only,
+        so parts, segments and workers share one copy via the page cache.
+        """
+        import numpy as np
+
+        extension = "{0}_{1}.f32".format(sample_rate, channels)
+        filename = self.decode(
+            dirname,
+            loglevel,
+            extension,
+            run,
+            format="f32le",
+            ac=channels,
+            ar=sample_rate,
+        )
+        with self.lock:
+            # mixes of a batch may mix in other sample formats
+            if self.samples is None or self.samples_extension != extension:
+                if os.path.getsize(filename) > 0:
+                    samples = np.memmap(filename, dtype=np.float32, mode="r")
+                else:
+                    samples = np.zeros(0, dtype=np.float32)
+                self.samples = samples.reshape(-1, channels)
+                self.samples_extension = extension
+            return self.samples
+
+    def identity(self):
+        file = os.path.realpath(self.path)
+        stat = os.stat(file)
+        return [file, stat.st_size, stat.st_mtime_ns]
 
 
 class Amix:
@@ -33,6 +279,11 @@ class Amix:
     Amix itself.
     """
 
+    engine = "ffmpeg"
+    transport = "file"
+    # parts sharing subgraphs can be rendered by one ffmpeg process
+    fan_out_parts = True
+
     def create(
         config,
         output,
@@ -44,12 +295,36 @@ class Amix:
         alias=None,
         name=None,
         parts_from_clips=False,
+        jobs=1,
+        cache=True,
+        cache_dir=None,
+        cache_size=1024,
+        single_graph=False,
+        format=None,
+        codec=None,
+        stdout=False,
+        preview=False,
+        segments=None,
+        bars=None,
+        recursive=False,
+        index=False,
+        optimize=False,
+        engine="ffmpeg",
+        transport="file",
+        trace=None,
+        batch=None,
     ):
+        import jsonschema
+        import yaml
+
+        tracer = batch.tracer if batch != None else Tracer(trace)
         if clip == None:
             clip = [os.path.dirname(config) + "/clips"]
         if alias == None:
             alias = []
-        with open(config) as f:
+        with tracer.span("load config", file=config):
+            with open(config) as f:
+                definition = f.read()
             if data != None:
                 new_data = {}
                 for d in data:
@@ -57,43 +332,51 @@ class Amix:
                     key = split[0]
                     val = split[1]
                     new_data[key] = val
-                definition = yaml.safe_load(Template(f.read()).render(new_data))
-            else:
-                definition = yaml.safe_load(f)
+                from jinja2 import Template
+
+                with tracer.span("render template"):
+                    definition = Template(definition).render(new_data)
+            definition = yaml.safe_load(definition)
 
         clips = []
-        types = ("*.mp3", "*.wav", "*.aif")
-        index = 0
+        library = None
+        if index and not cache:
+            raise Exception("Clip folders can only be indexed with the cache")
+        if index:
+            # folders are indexed in the probe cache
+            library = ProbeCache(
+                os.path.join(
+                    cache_dir if cache_dir else default_cache_dir(), "probes.json"
+                )
+            )
+        clip_index = 0
 
         if clip and len(clip) > 0:
             for file in clip:
                 file = os.path.relpath(file)
                 if os.path.isdir(file):
-                    files_grabbed = []
-                    for t in types:
-                        files_grabbed.extend(
-                            sorted(
-                                glob.glob(os.path.join(file, t)), key=os.path.getmtime
-                            )
-                        )
+                    with tracer.span("discover clips", folder=file):
+                        files_grabbed = discover(file, recursive, library)
                     for f in files_grabbed:
                         path = f
                         title = (
                             os.path.splitext(os.path.basename(f))[0]
-                            if index not in alias
-                            else alias[index]
+                            if clip_index not in alias
+                            else alias[clip_index]
                         )
-                        index += 1
+                        clip_index += 1
                         clips.append({"name": title, "path": path})
                 elif os.path.isfile(file):
                     path = file
                     title = (
                         os.path.splitext(os.path.basename(file))[0]
-                        if index not in alias
-                        else alias[index]
+                        if clip_index not in alias
+                        else alias[clip_index]
                     )
-                    index += 1
+                    clip_index += 1
                     clips.append({"name": title, "path": path})
+        if library != None:
+            library.save()
 
         if not "clips" in definition:
             if len(clips) > 0:
@@ -115,12 +398,36 @@ class Amix:
             definition["name"] = name
 
         try:
-            with open(os.path.join(os.path.dirname(__file__), "amix.json")) as f:
-                schema = json.load(f)
-            jsonschema.validate(definition, schema)
-            return Amix(definition, output, yes, loglevel, keep_tempfiles)
+            with tracer.span("validate schema"):
+                error = jsonschema.exceptions.best_match(
+                    _validator().iter_errors(definition)
+                )
+                if error is not None:
+                    raise error
+            return _engine(engine, transport)(
+                definition,
+                output,
+                yes,
+                loglevel,
+                keep_tempfiles,
+                jobs,
+                cache,
+                cache_dir,
+                cache_size,
+                single_graph,
+                format,
+                codec,
+                stdout,
+                preview,
+                segments,
+                bars,
+                optimize,
+                tracer,
+                batch,
+            )
         except jsonschema.exceptions.ValidationError as e:
             _logger.exception("Error while parsing amix definition file")
+            tracer.save()
             raise e
 
     def __init__(
@@ -130,12 +437,28 @@ class Amix:
         overwrite_output=False,
         loglevel=None,
         keep_tempfiles=False,
+        jobs=1,
+        cache=True,
+        cache_dir=None,
+        cache_size=1024,
+        single_graph=False,
+        format=None,
+        codec=None,
+        stdout=False,
+        preview=False,
+        segments=None,
+        bars=None,
+        optimize=False,
+        tracer=None,
+        batch=None,
     ):
         """
         Creates a Amix instance for a definition.
         """
 
         self.definition = definition
+        # the definition before restricting it to a window of the mix
+        self.full_definition = definition
         self.name = self.definition["name"]
         self.bar_time = (60 / self.definition["original_tempo"]) * 4
         self.output = output
@@ -150,18 +473,320 @@ class Amix:
         else:
             self.loglevel = "error"
         self.keep_tempfiles = keep_tempfiles
+        self.jobs = jobs if jobs > 0 else os.cpu_count()
+        self.cache_dir = cache_dir if cache_dir else default_cache_dir()
+        self.cache = (
+            RenderCache(os.path.join(self.cache_dir, "render"), cache_size)
+            if cache
+            else None
+        )
+        self.single_graph = single_graph
+        self.preview = preview
+        self.segments = segments
+        if bars != None and not 0 <= bars[0] < bars[1]:
+            raise Exception('Bars "{0}-{1}" are not a valid range'.format(*bars))
+        self.bars = bars
+        self.optimize = optimize
+        # previews are encoded to a small compressed file by default
+        self.format = format if format else ("mp3" if preview else "wav")
+        self.codec = codec
+        self.stdout = stdout
+        self.probe_cache = (
+            ProbeCache(os.path.join(self.cache_dir, "probes.json")) if cache else None
+        )
+        self.mix_files = None
+        self.tracer = tracer if tracer != None else Tracer()
+        self.batch = batch
+        # decoded clips are shared by all mixes of a batch
+        self.decode_dir = batch.tmp_dir if batch != None else self.tmp_dir
+
+    def _graph(self):
+        """
+        Resolves the clips, parts and filters reachable from the mix segments, so
+        nothing else is loaded or rendered. Dangling references are reported up
+        front and the filters are compiled once into a table indexed by name.
+        """
+
+        clips = set([c["name"] for c in self.definition["clips"]])
+        parts = {}
+        for part in self.definition.get("parts", []):
+            parts[part["name"]] = part
+
+        errors = []
+        used_parts = set()
+        for track in self.definition["mix"]:
+            for x in track["parts"]:
+                if x["name"] in parts:
+                    used_parts.add(x["name"])
+                else:
+                    errors.append(
+                        'Part "{0}" of segment "{1}" does not exist'.format(
+                            x["name"], track["name"]
+                        )
+                    )
+        used_clips = set()
+        for name in used_parts:
+            for x in parts[name]["clips"]:
+                if x["name"] in clips:
+                    used_clips.add(x["name"])
+                else:
+                    errors.append(
+                        'Clip "{0}" of part "{1}" does not exist'.format(
+                            x["name"], name
+                        )
+                    )
+
+        filters = {}
+        for filter in self.definition.get("filters", []):
+            filters.setdefault(filter["name"], filter)
+        used_filters = set()
+        hoisted = set()
+
+        def use_filters(x, kind, name):
+            for filter in x.get("filters", []):
+                if filter["name"] in filters:
+                    used_filters.add(filter["name"])
+                else:
+                    errors.append(
+                        'Filter "{0}" of {1} "{2}" does not exist'.format(
+                            filter["name"], kind, name
+                        )
+                    )
+
+        for track in self.definition["mix"]:
+            use_filters(track, "segment", track["name"])
+        for name in used_parts:
+            use_filters(parts[name], "part", name)
+            for x in parts[name]["clips"]:
+                use_filters(x, "clip", x["name"])
+
+        for name in used_filters:
+            filter = filters[name]
+            if not filter.get("hoist", False):
+                continue
+            # only filters keeping the length of the clip can be applied before looping
+            if (
+                filter["type"] != "pitch"
+                or float(filter.get("tempo", 1)) != 1
+                or "from" in filter
+            ):
+                errors.append('Filter "{0}" can not be hoisted'.format(name))
+            hoisted.add(name)
+
+        for e in errors:
+            _logger.error(e)
+        if len(errors) > 0:
+            raise Exception(errors[0])
+
+        compiled = {}
+        for name in used_filters:
+            filter_type, kwargs = self._parse_filter(filters[name], self.bar_time)
+            compiled[name] = (
+                filter_type,
+                {k: v for k, v in kwargs.items() if v is not None},
+            )
+
+        return {
+            "clips": [c for c in self.definition["clips"] if c["name"] in used_clips],
+            "parts": [
+                p for p in self.definition.get("parts", []) if p["name"] in used_parts
+            ],
+            "filters": compiled,
+            "hoisted": hoisted,
+        }
+
+    def validate(self):
+        """
+        Checks the references and filters of the definition without loading clips.
+        """
+        self._graph()
+
+    def _map(self, fn, items, kind, jobs=None):
+        """
+        Calls fn for every named item, using a worker pool for multiple jobs.
+        Results keep the order of the items, errors are reported per item.
+        """
+
+        jobs = jobs if jobs else self.jobs
+
+        def traced(item):
+            with self.tracer.span(
+                "{0} {1}".format(kind, item["name"]), kind, **{kind: item["name"]}
+            ):
+                return fn(item)
+
+        if jobs == 1 or len(items) < 2:
+            return [traced(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(traced, item) for item in items]
+
+        results = []
+        errors = []
+        for item, future in zip(items, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                _logger.error(
+                    'Error while processing {0} "{1}": {2}'.format(
+                        kind, item["name"], e
+                    )
+                )
+                errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def _ffmpeg(self, stream, **kwargs):
+        """
+        Runs an ffmpeg output stream, traced with its command line.
+        """
+        with self.tracer.command(
+            "ffmpeg",
+            ffmpeg.compile(
+                stream, overwrite_output=kwargs.get("overwrite_output", False)
+            ),
+        ):
+            if self.batch == None:
+                return stream.run(**kwargs)
+            with self.batch.semaphore:
+                return stream.run(**kwargs)
+
+    def _ffprobe(self, file):
+        """
+        Probes a file, traced with its command line.
+        """
+        with self.tracer.command(
+            "ffprobe",
+            ["ffprobe", "-show_format", "-show_streams", "-of", "json", file],
+        ):
+            if self.batch == None:
+                return ffmpeg.probe(file)
+            with self.batch.semaphore:
+                return ffmpeg.probe(file)
 
     def _load_clips(self):
         """
-        Loads clips.
+        Loads the clips reachable from the mix.
         """
 
         _logger.info("Loading clips")
-        self.clips = {}
-        for c in self.definition["clips"]:
+        self.definition = self.full_definition
+        self.graph = self._graph()
+        self.chains = {}
+
+        def load(c):
+            if self.batch != None:
+                return self.batch.clip(
+                    c["name"],
+                    c["path"],
+                    lambda clip: clip.load(self.probe_cache, self._ffprobe),
+                )
             clip = _Clip(c["name"], c["path"])
-            clip.load()
-            self.clips[clip.name] = clip
+            clip.load(self.probe_cache, self._ffprobe)
+            return clip
+
+        def probe(c):
+            clip = load(c)
+            # every loaded clip is used by a reachable part, so probing
+            # it here in parallel saves waiting for it in part layouts
+            clip.probe
+            return clip
+
+        # probing is bound by process spawns and I/O rather than CPU
+        clips = self._map(
+            probe,
+            self.graph["clips"],
+            "clip",
+            max(self.jobs, min(32, os.cpu_count() + 4)),
+        )
+        self.clips = {}
+        for c, clip in zip(self.graph["clips"], clips):
+            self.clips[c["name"]] = clip
+        if self.probe_cache != None:
+            self.probe_cache.save()
+        self._select_window()
+
+    def _part_duration(self, part, bars_global):
+        """
+        Calculates the length of a part in seconds from its clips, loops and offsets.
+        """
+        clips, _ = self._layout_part(part, bars_global)
+        return max(
+            [
+                (int(x["loop"]) + 1)
+                * (
+                    min(float(x["clip"].probe["duration"]), x["clip_time"])
+                    + x["offset"] * self.bar_time
+                )
+                for x in clips
+            ]
+            + [0]
+        )
+
+    def _select_window(self):
+        """
+        Restricts the mix to the selected segments and range of bars. The parts of
+        segments partly in the range are rendered for their window only.
+        """
+        if self.segments == None and self.bars == None:
+            return
+
+        names = [track["name"] for track in self.full_definition["mix"]]
+        for name in self.segments if self.segments != None else []:
+            if name not in names:
+                raise Exception('Segment "{0}" does not exist'.format(name))
+        start, end = (0, math.inf)
+        if self.bars != None:
+            start, end = [b * self.bar_time for b in self.bars]
+
+        bars_global = self.full_definition.get("bars", 16)
+        parts = {}
+        for part in self.full_definition.get("parts", []):
+            parts[part["name"]] = part
+        mix = []
+        windows = {}
+        time = 0
+        for track in self.full_definition["mix"]:
+            duration = max(
+                [
+                    self._part_duration(parts[x["name"]], bars_global)
+                    for x in track["parts"]
+                ]
+                + [0]
+            )
+            window = [max(start - time, 0), min(end - time, duration)]
+            time += duration
+            if window[0] >= window[1] or (
+                self.segments != None and track["name"] not in self.segments
+            ):
+                continue
+            if window == [0, duration]:
+                mix.append(track)
+                continue
+            _logger.info(
+                'Rendering segment "{0}" from {1}s to {2}s'.format(
+                    track["name"], *window
+                )
+            )
+            track = dict(track, window=window, parts=[dict(x) for x in track["parts"]])
+            for x in track["parts"]:
+                # windowed parts are rendered separately from the whole ones
+                name = "{0}@{1:g}-{2:g}".format(
+                    x["name"], window[0] / self.bar_time, window[1] / self.bar_time
+                )
+                windows[name] = dict(parts[x["name"]], name=name, window=window)
+                x["name"] = name
+            mix.append(track)
+        if len(mix) == 0:
+            raise Exception("No segments are in the selected window")
+
+        self.definition = dict(
+            self.full_definition,
+            mix=mix,
+            parts=self.full_definition.get("parts", []) + list(windows.values()),
+        )
+        self.graph = self._graph()
 
     def _parse_filter(self, filter, bar_time):
         """
@@ -206,35 +831,157 @@ class Amix:
             kwargs["formant"] = filter.get("formant", "shifted")
             kwargs["pitchq"] = filter.get("pitchq", "quality")
             kwargs["channels"] = filter.get("channels", "apart")
+            if self.preview:
+                kwargs.update(_PREVIEW_RUBBERBAND)
             filter_type = "rubberband"
         else:
             raise Exception('Filter "{0}" does not exist'.format(filter_type))
 
         return filter_type, kwargs
 
+    def _resolve_filters(self, list):
+        """
+        Resolves filter references to compiled filter types and arguments,
+        once per distinct chain.
+        """
+        names = tuple([filter["name"] for filter in list])
+        if names not in self.chains:
+            chain = [self.graph["filters"][name] for name in names]
+            if self.optimize:
+                chain = _optimize_filters(chain)
+            self.chains[names] = chain
+        return self.chains[names]
+
+    def _split_filters(self, list):
+        """
+        Splits filter references into hoisted and remaining ones.
+        """
+        return (
+            [f for f in list if f["name"] in self.graph["hoisted"]],
+            [f for f in list if f["name"] not in self.graph["hoisted"]],
+        )
+
+    def _hoist_key(self, clip, list):
+        """
+        Creates the key of a clip with hoisted filters applied.
+        """
+        data = {
+            "type": "clip",
+            "clip": clip.identity(),
+            "filters": self._resolve_filters(list),
+        }
+        # keyed without a cache too, as the file is named after the key
+        if self.preview:
+            data["preview"] = [_PREVIEW_SAMPLE_RATE, _PREVIEW_CHANNELS]
+        return RenderCache.key(data)
+
+    def _hoist(self, clip, list):
+        """
+        Applies hoisted filters once to the source clip, cached by clip identity
+        and filter arguments. Returns the file of the filtered clip.
+        """
+        key = self._hoist_key(clip, list)
+        filename = os.path.join(self.decode_dir, "{0}.wav".format(key))
+        with clip.lock:
+            if key not in clip.hoisted:
+                if self.cache == None or not self.cache.get(key, filename):
+                    _logger.info(
+                        'Applying hoisted filters to clip "{0}" in "{1}"'.format(
+                            clip.name, filename
+                        )
+                    )
+                    self._ffmpeg(
+                        self._apply_filters(self._clip_input(clip), list).output(
+                            filename, loglevel=self.loglevel
+                        ),
+                        overwrite_output=True,
+                    )
+                    self._store(key, filename)
+                clip.hoisted[key] = filename
+        return clip.hoisted[key]
+
+    def _decode_format(self):
+        """
+        Returns the extension and output arguments clips are decoded with.
+        """
+        if self.preview:
+            return "preview.wav", dict(ar=_PREVIEW_SAMPLE_RATE, ac=_PREVIEW_CHANNELS)
+        return "wav", {}
+
+    def _decode(self, clip):
+        """
+        Decodes a clip once to a file, shared by all parts using it.
+        """
+        extension, kwargs = self._decode_format()
+        return clip.decode(
+            self.decode_dir, self.loglevel, extension, self._ffmpeg, **kwargs
+        )
+
+    def _clip_input(self, clip):
+        """
+        Returns the input stream of a clip, resampled to the preview format in
+        preview mode.
+        """
+        if self.preview:
+            return clip.input.filter("aresample", _PREVIEW_SAMPLE_RATE).filter(
+                "aformat", channel_layouts="mono"
+            )
+        return clip.input
+
     def _apply_filters(self, clip, list):
         """
         Applys filters to a clip.
         """
-        for filter in list:
-            filter_type, kwargs = self._parse_filter(
-                [x for x in self.definition["filters"] if x["name"] == filter["name"]][
-                    0
-                ],
-                self.bar_time,
-            )
-            clip = ffmpeg.filter(
-                clip, filter_type, **{k: v for k, v in kwargs.items() if v is not None}
-            )
+        for filter_type, kwargs in self._resolve_filters(list):
+            clip = ffmpeg.filter(clip, filter_type, **kwargs)
         return clip
 
-    def _create_mix_part(self, part, bars_global=None):
+    def _key(self, data):
         """
-        Creates relevant mix parts.
+        Creates the cache key for render inputs.
+        """
+        if self.cache == None and self.batch == None:
+            return None
+        if self.preview:
+            data = dict(data, preview=[_PREVIEW_SAMPLE_RATE, _PREVIEW_CHANNELS])
+        return RenderCache.key(data)
+
+    def _restore(self, key, filename):
+        """
+        Restores a rendered file from the cache.
+        """
+        if self.cache == None:
+            return False
+        if os.path.exists(filename) and not self.overwrite_output:
+            return False
+        return self.cache.get(key, filename)
+
+    def _store(self, key, filename):
+        """
+        Stores a rendered file in the cache.
+        """
+        if self.cache != None:
+            self.cache.put(key, filename)
+
+    def _render(self, key, filename, render):
+        """
+        Renders a file with render, unless it is cached or rendered by the batch.
+        """
+        if self._restore(key, filename):
+            return
+        if self.batch != None and (
+            self.overwrite_output or not os.path.exists(filename)
+        ):
+            if not self.batch.render(key, filename, render):
+                return
+        else:
+            render()
+        self._store(key, filename)
+
+    def _layout_part(self, part, bars_global):
+        """
+        Calculates bars, loops and offsets of the clips in a part.
         """
-        _logger.info("Creating mix parts")
-        name = part["name"]
-        _logger.info('Creating mix part "{0}"'.format(name))
         clips = []
         for definition in part["clips"]:
             c = self.clips[definition["name"]]
@@ -249,6 +996,8 @@ class Amix:
             else:
                 bars = bars_part % bars_original
 
+            hoisted, filters = self._split_filters(definition.get("filters", []))
+            hoisted += self._split_filters(part.get("filters", []))[0]
             offset = int(definition.get("offset", 0))
             if "loop" in definition:
                 loop = int(definition["loop"])
@@ -260,22 +1009,23 @@ class Amix:
                 loop = bars_part / (bars) - 1
             clip_time = bars * self.bar_time
 
-            sample_rate = int(c.probe["sample_rate"])
-            hash = random.getrandbits(128)
-
-            tmp_filename = os.path.join(self.tmp_dir, "%032x.wav" % hash)
-            c.input.output(tmp_filename, loglevel=self.loglevel).run()
-            clip = ffmpeg.input(tmp_filename)
-            if offset > 0:
-                clip = ffmpeg.filter(clip, "apad", pad_dur=offset * self.bar_time)
-                clip_time += offset * self.bar_time
-            clip = ffmpeg.filter(clip, "atrim", start=0, end=clip_time)
-            clip = ffmpeg.filter(clip, "aloop", loop=loop, size=sample_rate * clip_time)
-
-            if "filters" in definition:
-                clip = self._apply_filters(clip, definition["filters"])
-
-            clips.append({"definition": definition, "clip": clip})
+            clips.append(
+                {
+                    "definition": definition,
+                    "clip": c,
+                    "bars": bars_part,
+                    "offset": offset,
+                    "loop": loop,
+                    "clip_time": clip_time,
+                    "sample_rate": (
+                        _PREVIEW_SAMPLE_RATE
+                        if self.preview
+                        else int(c.probe["sample_rate"])
+                    ),
+                    "hoisted": hoisted,
+                    "filters": filters,
+                }
+            )
 
         weights = " ".join(
             [
@@ -288,43 +1038,257 @@ class Amix:
                 len(clips), [x["definition"]["name"] for x in clips], weights
             )
         )
+        return clips, weights
+
+    def _build_part(self, part, clips, weights, source):
+        """
+        Builds the filter graph of a part, reading clips with their hoisted
+        filters applied from source.
+        """
+        streams = []
+        for x in clips:
+            clip = source(x["clip"], x["hoisted"])
+            clip_time = x["clip_time"]
+            if x["offset"] > 0:
+                clip = ffmpeg.filter(clip, "apad", pad_dur=x["offset"] * self.bar_time)
+                clip_time += x["offset"] * self.bar_time
+            clip = ffmpeg.filter(clip, "atrim", start=0, end=clip_time)
+            clip = ffmpeg.filter(
+                clip, "aloop", loop=x["loop"], size=x["sample_rate"] * clip_time
+            )
+            if "window" in part:
+                # timestamps are kept, so filters see the time within the part
+                clip = ffmpeg.filter(
+                    clip, "atrim", start=part["window"][0], end=part["window"][1]
+                )
+
+            if len(x["filters"]) > 0:
+                clip = self._apply_filters(clip, x["filters"])
+
+            streams.append(clip)
 
-        filename = os.path.join(self.parts_dir, "{0}.wav".format(name))
-        _logger.info(
-            'Creating temporary file "{0}" for part "{1}"'.format(name, filename)
-        )
         clip = ffmpeg.filter(
-            [x["clip"] for x in clips],
+            streams,
             "amix",
             weights=weights,
-            inputs=len(clips),
+            inputs=len(streams),
             normalize=False,
         )
 
-        if "filters" in part:
-            clip = self._apply_filters(clip, part["filters"])
+        filters = self._split_filters(part.get("filters", []))[1]
+        if len(filters) > 0:
+            clip = self._apply_filters(clip, filters)
+        if "window" in part:
+            clip = ffmpeg.filter(clip, "asetpts", "N/SR/TB")
+        return clip
+
+    def _output(self, outputs):
+        """
+        Merges streams to files into a single ffmpeg output.
+        Outputs are tuples of stream, filename and optional output arguments.
+        """
+        streams = _fan_out([output[0] for output in outputs])
+        return ffmpeg.merge_outputs(
+            *[
+                stream.output(
+                    output[1],
+                    loglevel=self.loglevel,
+                    **(output[2] if len(output) > 2 else {}),
+                )
+                for stream, output in zip(streams, outputs)
+            ]
+        )
 
-        clip.output(filename, loglevel=self.loglevel).run(
-            overwrite_output=self.overwrite_output
+    def _run(self, outputs, input=None):
+        """
+        Renders streams to files with a single ffmpeg process.
+        """
+        self._ffmpeg(
+            self._output(outputs), input=input, overwrite_output=self.overwrite_output
         )
+
+    def _create_mix_part(self, part, bars_global=None):
+        """
+        Creates a mix part.
+        """
+        name = part["name"]
+        _logger.info('Creating mix part "{0}"'.format(name))
+        clips, weights = self._layout_part(part, bars_global)
+        key = self._part_key(part, clips, weights)
+        filename = os.path.join(self.parts_dir, "{0}.wav".format(name))
+        self.mix_part_keys[name] = key
+
+        def render():
+            clip = self._build_part(part, clips, weights, self._part_source)
+            _logger.info(
+                'Creating temporary file "{0}" for part "{1}"'.format(name, filename)
+            )
+            self._run([(clip, filename)])
+
+        self._render(key, filename, render)
         self.mix_parts[name] = ffmpeg.input(filename)
 
+    def _part_source(self, clip, hoisted):
+        """
+        Returns the input of a clip in a part, with its hoisted filters applied.
+        """
+        if len(self._resolve_filters(hoisted)) > 0:
+            return ffmpeg.input(self._hoist(clip, hoisted))
+        return ffmpeg.input(self._decode(clip))
+
+    def _group_parts(self, parts, bars_global):
+        """
+        Groups parts sharing a subgraph, either all their clips and weights, like
+        parts only differing in their filters, or a clip with the same filters.
+        """
+        groups = list(range(len(parts)))
+
+        def find(i):
+            while groups[i] != i:
+                groups[i] = groups[groups[i]]
+                i = groups[i]
+            return i
+
+        owners = {}
+        for i, part in enumerate(parts):
+            clips, weights = self._layout_part(part, bars_global)
+            signatures = [
+                [
+                    x["clip"].identity(),
+                    x["bars"],
+                    x["offset"],
+                    x["loop"],
+                    x["clip_time"],
+                    self._resolve_filters(x["hoisted"]),
+                    self._resolve_filters(x["filters"]),
+                ]
+                for x in clips
+            ]
+            window = part.get("window")
+            shared = [
+                RenderCache.key(
+                    {"clips": signatures, "weights": weights, "window": window}
+                )
+            ]
+            # clips without filters only share their decoding
+            shared += [
+                RenderCache.key({"clip": signature, "window": window})
+                for signature in signatures
+                if len(signature[6]) > 0
+            ]
+            for signature in shared:
+                groups[find(i)] = find(owners.setdefault(signature, i))
+
+        grouped = {}
+        for i, part in enumerate(parts):
+            grouped.setdefault(find(i), []).append(part)
+        return [
+            {"name": "+".join([part["name"] for part in group]), "parts": group}
+            for group in grouped.values()
+        ]
+
+    def _create_mix_part_group(self, parts, bars_global=None):
+        """
+        Creates mix parts sharing subgraphs with a single ffmpeg process, so
+        their shared subgraphs are rendered only once.
+        """
+        if len(parts) == 1:
+            return self._create_mix_part(parts[0], bars_global)
+
+        outputs = []
+        for part in parts:
+            name = part["name"]
+            _logger.info('Creating mix part "{0}"'.format(name))
+            clips, weights = self._layout_part(part, bars_global)
+            key = self._part_key(part, clips, weights)
+            filename = os.path.join(self.parts_dir, "{0}.wav".format(name))
+            self.mix_part_keys[name] = key
+            self.mix_parts[name] = ffmpeg.input(filename)
+            if not self._restore(key, filename):
+                clip = self._build_part(part, clips, weights, self._part_source)
+                outputs.append((clip, filename, key))
+
+        if len(outputs) > 0:
+            _logger.info(
+                'Creating temporary files "{0}" for parts sharing subgraphs'.format(
+                    [o[1] for o in outputs]
+                )
+            )
+            self._run([(clip, filename) for clip, filename, key in outputs])
+            for clip, filename, key in outputs:
+                self._store(key, filename)
+
+    def _part_key(self, part, clips, weights):
+        """
+        Creates the cache key of a part from its clips and filters.
+        """
+        data = {}
+        if "window" in part:
+            data["window"] = part["window"]
+        return self._key(
+            {
+                **data,
+                "type": "part",
+                "bar_time": self.bar_time,
+                "clips": [
+                    {
+                        "clip": x["clip"].identity(),
+                        "bars": x["bars"],
+                        "offset": x["offset"],
+                        "loop": x["loop"],
+                        "clip_time": x["clip_time"],
+                        "hoisted": self._resolve_filters(x["hoisted"]),
+                        "filters": self._resolve_filters(x["filters"]),
+                    }
+                    for x in clips
+                ],
+                "weights": weights,
+                "filters": self._resolve_filters(
+                    self._split_filters(part.get("filters", []))[1]
+                ),
+            }
+        )
+
     def _setup(self):
         """
         Sets up amix.
         """
         _logger.info("Setting up amix")
         self._load_clips()
+        self._make_dirs()
+
+        if not self.single_graph:
+            self._create_mix_parts()
+
+    def _make_dirs(self):
+        """
+        Creates the output folders.
+        """
         Path(self.parts_dir).mkdir(parents=True, exist_ok=True)
         Path(self.mix_dir).mkdir(parents=True, exist_ok=True)
         Path(self.tmp_dir).mkdir(parents=True, exist_ok=True)
 
+    def _create_mix_parts(self):
+        """
+        Creates relevant mix parts.
+        """
+        _logger.info("Creating mix parts")
         self.mix_parts = {}
-        for part in self.definition["parts"]:
-            self._create_mix_part(
-                part,
-                self.definition.get("bars", 16),
+        self.mix_part_keys = {}
+        bars_global = self.definition.get("bars", 16)
+        # batches share renders per part instead
+        if self.optimize and self.fan_out_parts and self.batch == None:
+            self._map(
+                lambda group: self._create_mix_part_group(group["parts"], bars_global),
+                self._group_parts(self.graph["parts"], bars_global),
+                "part",
             )
+            return
+        self._map(
+            lambda part: self._create_mix_part(part, bars_global),
+            self.graph["parts"],
+            "part",
+        )
 
     def _create_mix(self):
         """
@@ -332,52 +1296,217 @@ class Amix:
         """
         _logger.info("Creating mix")
         definition = self.definition["mix"]
-        mix = []
         mix_dir = os.path.join(self.mix_dir, self.definition["name"])
         Path(mix_dir).mkdir(parents=True, exist_ok=True)
-        for track in definition:
-            weights = " ".join(
-                [str(x["weight"] if "weight" in x else "1") for x in track["parts"]]
+        self.mix_outputs = []
+        if self.single_graph:
+            mix = self._create_mix_graph(mix_dir)
+        else:
+            mix = self._map(
+                lambda track: self._create_mix_segment(track, mix_dir),
+                definition,
+                "segment",
             )
-            parts = [self.mix_parts[x["name"]] for x in track["parts"]]
-            _logger.debug(
-                'Using {0} parts "{1}" with weights "{2}"'.format(
-                    len(parts), [x["name"] for x in parts], weights
-                )
+            self.mix_files = [
+                os.path.join(mix_dir, "{0}.wav".format(track["name"]))
+                for track in definition
+            ]
+        self.mix = ffmpeg.filter(mix, "concat", n=len(mix), v=0, a=1)
+
+    def _segment_weights(self, track):
+        """
+        Joins the weights of the parts in a segment.
+        """
+        weights = " ".join(
+            [str(x["weight"] if "weight" in x else "1") for x in track["parts"]]
+        )
+        _logger.debug(
+            'Using {0} parts "{1}" with weights "{2}"'.format(
+                len(track["parts"]), [x["name"] for x in track["parts"]], weights
             )
-            filename = os.path.join(mix_dir, "{0}.wav".format(track["name"]))
+        )
+        return weights
+
+    def _build_segment(self, track, parts, weights):
+        """
+        Builds the filter graph of a segment from part streams.
+        """
+        if "window" in track:
+            parts = [
+                ffmpeg.filter(p, "asetpts", "N/SR/TB+{0}/TB".format(track["window"][0]))
+                for p in parts
+            ]
+        clip = ffmpeg.filter(
+            parts,
+            "amix",
+            weights=weights,
+            inputs=len(parts),
+            normalize=False,
+        )
+
+        if "filters" in track:
+            clip = self._apply_filters(clip, track["filters"])
+        if "window" in track:
+            clip = ffmpeg.filter(clip, "asetpts", "N/SR/TB")
+        return clip
+
+    def _segment_key(self, track, weights):
+        """
+        Creates the cache key of a segment from its parts and filters.
+        """
+        return self._key(
+            {
+                "type": "segment",
+                "bar_time": self.bar_time,
+                "parts": [self.mix_part_keys[x["name"]] for x in track["parts"]],
+                "weights": weights,
+                "filters": self._resolve_filters(track.get("filters", [])),
+            }
+        )
+
+    def _create_mix_segment(self, track, mix_dir):
+        """
+        Creates a mix segment.
+        """
+        weights = self._segment_weights(track)
+        parts = [self.mix_parts[x["name"]] for x in track["parts"]]
+        key = self._segment_key(track, weights)
+        filename = os.path.join(mix_dir, "{0}.wav".format(track["name"]))
+
+        def render():
             _logger.info(
                 'Creating temporary file "{0}" for part "{1}"'.format(
                     track["name"], filename
                 )
             )
-            clip = ffmpeg.filter(
-                [x for x in parts],
-                "amix",
-                weights=weights,
-                inputs=len(parts),
-                normalize=False,
+            clip = self._build_segment(track, parts, weights)
+            self._run([(clip, filename)])
+
+        self._render(key, filename, render)
+        return ffmpeg.input(filename)
+
+    def _create_mix_graph(self, mix_dir):
+        """
+        Compiles clips, parts and segments into a single filter graph.
+        Intermediate files are only added as outputs when temp files are kept.
+        """
+        _logger.info("Creating single mix graph")
+        bars_global = self.definition.get("bars", 16)
+        parts = {}
+        for part in self.graph["parts"]:
+            parts[part["name"]] = part
+
+        streams = {}
+        for track in self.definition["mix"]:
+            for x in track["parts"]:
+                if x["name"] in streams:
+                    continue
+                part = parts[x["name"]]
+                clips, weights = self._layout_part(part, bars_global)
+                streams[x["name"]] = self._build_part(
+                    part,
+                    clips,
+                    weights,
+                    lambda c, hoisted: self._apply_filters(
+                        self._clip_input(c), hoisted
+                    ),
+                )
+                if self.keep_tempfiles:
+                    filename = os.path.join(self.parts_dir, "{0}.wav".format(x["name"]))
+                    self.mix_outputs.append((streams[x["name"]], filename))
+
+        mix = []
+        for track in self.definition["mix"]:
+            clip = self._build_segment(
+                track,
+                [streams[x["name"]] for x in track["parts"]],
+                self._segment_weights(track),
+            )
+            if self.keep_tempfiles:
+                filename = os.path.join(mix_dir, "{0}.wav".format(track["name"]))
+                self.mix_outputs.append((clip, filename))
+            mix.append(clip)
+        return mix
+
+    def _mix_output(self):
+        """
+        Returns the output of the mix, with its filename and output arguments.
+        """
+        if self.stdout:
+            filename = "pipe:1"
+        else:
+            filename = os.path.join(
+                self.output, "{0}.{1}".format(self.definition["name"], self.format)
             )
+        _logger.info('Rendering mix to "{0}"'.format(filename))
+        kwargs = dict(format=self.format)
+        if self.codec:
+            kwargs["acodec"] = self.codec
+        if self.preview:
+            kwargs["audio_bitrate"] = "64k"
+        return (self.mix, filename, kwargs)
+
+    def _mix_formats(self):
+        """
+        Returns the WAV formats of the mix segments.
+        """
+        formats = []
+        for filename in self.mix_files:
+            with open(filename, "rb") as f:
+                formats.append(_wav_format(f))
+        return formats
 
-            if "filters" in track:
-                clip = self._apply_filters(clip, track["filters"])
+    def _copy_mix(self):
+        """
+        Returns whether the mix segments can be joined by stream copy, which needs
+        them to be 16 bit PCM of the same format, like the mix.
+        """
+        if self.mix_files == None or len(self.mix_outputs) > 0:
+            return False
+        if self.format != "wav" or self.codec not in (None, "pcm_s16le"):
+            return False
+        formats = self._mix_formats()
+        if formats[0] == None or len(formats[0]) < 16:
+            return False
+        tag, channels, rate, byte_rate, align, bits = struct.unpack(
+            "<HHIIHH", formats[0][:16]
+        )
+        return tag in (1, 0xFFFE) and bits == 16 and len(set(formats)) == 1
+
+    def _render_outputs(self):
+        """
+        Returns the outputs rendering the mix and the input to pass to ffmpeg.
+        Segments are joined by the concat demuxer and stream copy if possible,
+        instead of decoding and encoding them again with the concat filter.
+        """
+        if not self._copy_mix():
+            return [self._mix_output()] + self.mix_outputs, None
 
-            clip.output(filename, loglevel=self.loglevel).run(
-                overwrite_output=self.overwrite_output
+        _logger.info("Joining mix segments by stream copy")
+        files = "".join(
+            [
+                "file 'file:{0}'\n".format(os.path.abspath(f).replace("'", "'\\''"))
+                for f in self.mix_files
+            ]
+        )
+        mix, filename, kwargs = self._mix_output()
+        return [
+            (
+                # the list is read from stdin, naming the segments by absolute path
+                ffmpeg.input(
+                    "pipe:", format="concat", safe=0, protocol_whitelist="pipe,file"
+                ),
+                filename,
+                dict(kwargs, acodec="copy"),
             )
-            mix.append(ffmpeg.input(filename))
-        self.mix = ffmpeg.filter(mix, "concat", n=len(mix), v=0, a=1)
+        ], files.encode("utf-8")
 
     def _render_mix(self):
         """
         Renders the mix to disc.
         """
         _logger.info("Rendering mix")
-        filename = os.path.join(self.output, "{0}.wav".format(self.definition["name"]))
-        _logger.info('Rendering mix to "{0}"'.format(filename))
-        self.mix.output(filename, loglevel=self.loglevel).run(
-            overwrite_output=self.overwrite_output
-        )
+        self._run(*self._render_outputs())
 
     def _cleanup(self):
         """
@@ -392,7 +1521,268 @@ class Amix:
         The generator method, sets up everything, creates temporary files, parts and renders the mixes.
         """
 
-        self._setup()
-        self._create_mix()
-        self._render_mix()
-        self._cleanup()
+        try:
+            with self.tracer.span("setup"):
+                self._setup()
+            with self.tracer.span("create mix"):
+                self._create_mix()
+            with self.tracer.span("render mix"):
+                self._render_mix()
+            with self.tracer.span("cleanup"):
+                self._cleanup()
+        finally:
+            if self.batch == None:
+                self.tracer.save()
+
+    async def _aexec(self, name, args, input=None, capture=False, partial=None):
+        """
+        Runs a subprocess with asyncio, waiting for a free job slot first.
+        When cancelled, the process is killed and its partial files are removed.
+        """
+        async with self.semaphore:
+            with self.tracer.command(name, args):
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=asyncio.subprocess.PIPE
+                    if input is not None
+                    else asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE if capture else None,
+                    stderr=asyncio.subprocess.PIPE if capture else None,
+                )
+                try:
+                    out, err = await process.communicate(input)
+                except asyncio.CancelledError:
+                    try:
+                        process.kill()
+                    except ProcessLookupError:
+                        pass
+                    await process.wait()
+                    for filename in partial if partial else []:
+                        if os.path.isfile(filename):
+                            _logger.info('Removing partial file "{0}"'.format(filename))
+                            os.remove(filename)
+                    raise
+        if process.returncode != 0:
+            raise ffmpeg.Error(name, out, err)
+        return out, err
+
+    async def _agather(self, fn, items, kind):
+        """
+        Awaits fn for every named item concurrently. Results keep the order of the
+        items, on the first error the remaining items are cancelled.
+        """
+
+        async def traced(item):
+            with self.tracer.span(
+                "{0} {1}".format(kind, item["name"]), kind, **{kind: item["name"]}
+            ):
+                return await fn(item)
+
+        if len(items) == 0:
+            return []
+        tasks = [asyncio.ensure_future(traced(item)) for item in items]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        errors = []
+        for item, task in zip(items, tasks):
+            if not task.cancelled() and task.exception() != None:
+                _logger.error(
+                    'Error while processing {0} "{1}": {2}'.format(
+                        kind, item["name"], task.exception()
+                    )
+                )
+                errors.append(task.exception())
+        if len(errors) > 0:
+            raise errors[0]
+        return [task.result() for task in tasks]
+
+    async def _aload_clips(self):
+        """
+        Loads the clips reachable from the mix, probing them with asyncio.
+        """
+        _logger.info("Loading clips")
+        self.definition = self.full_definition
+        self.graph = self._graph()
+        self.chains = {}
+
+        async def load(c):
+            clip = _Clip(c["name"], c["path"])
+            file = os.path.realpath(c["path"])
+            probe = None
+            if self.probe_cache == None or self.probe_cache.get(file) == None:
+                out, _ = await self._aexec(
+                    "ffprobe",
+                    ["ffprobe", "-show_format", "-show_streams", "-of", "json", file],
+                    capture=True,
+                )
+                probe = json.loads(out.decode("utf-8"))
+            clip.load(self.probe_cache, lambda file: probe)
+            # the probe already ran here, to not block the event loop later
+            clip.probe
+            return clip
+
+        clips = await self._agather(load, self.graph["clips"], "clip")
+        self.clips = {}
+        for c, clip in zip(self.graph["clips"], clips):
+            self.clips[c["name"]] = clip
+        if self.probe_cache != None:
+            self.probe_cache.save()
+        self._select_window()
+
+    async def _adecode(self, clip):
+        """
+        Decodes a clip once with asyncio, shared by all parts using it.
+        """
+
+        extension, kwargs = self._decode_format()
+
+        async def decode():
+            if extension in clip.decoded:
+                return
+            filename = clip.filename(self.decode_dir, extension)
+            _logger.info('Decoding clip "{0}" to "{1}"'.format(clip.name, filename))
+            await self._aexec(
+                "ffmpeg",
+                ffmpeg.compile(
+                    clip.input.output(filename, loglevel=self.loglevel, **kwargs),
+                    overwrite_output=True,
+                ),
+                partial=[filename],
+            )
+            clip.decoded[extension] = filename
+
+        if clip not in self.decodes:
+            self.decodes[clip] = asyncio.ensure_future(decode())
+        # a cancelled part must not cancel the decoding for the other parts
+        await asyncio.shield(self.decodes[clip])
+        return clip.decoded[extension]
+
+    async def _arun(self, outputs, input=None):
+        """
+        Renders streams to files with a single ffmpeg process run with asyncio.
+        """
+        await self._aexec(
+            "ffmpeg",
+            ffmpeg.compile(
+                self._output(outputs), overwrite_output=self.overwrite_output
+            ),
+            input=input,
+            partial=[o[1] for o in outputs if not o[1].startswith("pipe:")],
+        )
+
+    async def _acreate_mix_part(self, part, bars_global=None):
+        """
+        Creates a mix part with asyncio.
+        """
+        name = part["name"]
+        _logger.info('Creating mix part "{0}"'.format(name))
+        clips, weights = self._layout_part(part, bars_global)
+        key = self._part_key(part, clips, weights)
+        filename = os.path.join(self.parts_dir, "{0}.wav".format(name))
+        self.mix_part_keys[name] = key
+
+        if not self._restore(key, filename):
+            decoded = await asyncio.gather(*[self._adecode(x["clip"]) for x in clips])
+            decoded = dict(zip([x["clip"] for x in clips], decoded))
+            # hoisted filters are applied in the part graph, still before looping
+            clip = self._build_part(
+                part,
+                clips,
+                weights,
+                lambda c, hoisted: self._apply_filters(
+                    ffmpeg.input(decoded[c]), hoisted
+                ),
+            )
+            _logger.info(
+                'Creating temporary file "{0}" for part "{1}"'.format(name, filename)
+            )
+            await self._arun([(clip, filename)])
+            self._store(key, filename)
+        self.mix_parts[name] = ffmpeg.input(filename)
+
+    async def _acreate_mix_segment(self, track, mix_dir):
+        """
+        Creates a mix segment with asyncio.
+        """
+        weights = self._segment_weights(track)
+        key = self._segment_key(track, weights)
+        filename = os.path.join(mix_dir, "{0}.wav".format(track["name"]))
+        if not self._restore(key, filename):
+            _logger.info(
+                'Creating temporary file "{0}" for part "{1}"'.format(
+                    track["name"], filename
+                )
+            )
+            clip = self._build_segment(
+                track, [self.mix_parts[x["name"]] for x in track["parts"]], weights
+            )
+            await self._arun([(clip, filename)])
+            self._store(key, filename)
+        return ffmpeg.input(filename)
+
+    async def arun(self):
+        """
+        Like :func:`run`, but runs ffmpeg as asyncio subprocesses, at most jobs at
+        once. When cancelled, running processes are killed and partial files removed.
+        """
+
+        if self.engine != "ffmpeg":
+            raise Exception('Engine "{0}" does not support arun'.format(self.engine))
+        if self.transport != "file":
+            raise Exception(
+                'Transport "{0}" does not support arun'.format(self.transport)
+            )
+
+        self.semaphore = asyncio.Semaphore(self.jobs)
+        self.decodes = {}
+        cancelled = False
+        try:
+            with self.tracer.span("setup"):
+                await self._aload_clips()
+                self._make_dirs()
+                self.mix_parts = {}
+                self.mix_part_keys = {}
+                if not self.single_graph:
+                    bars_global = self.definition.get("bars", 16)
+                    await self._agather(
+                        lambda part: self._acreate_mix_part(part, bars_global),
+                        self.graph["parts"],
+                        "part",
+                    )
+            with self.tracer.span("create mix"):
+                mix_dir = os.path.join(self.mix_dir, self.definition["name"])
+                Path(mix_dir).mkdir(parents=True, exist_ok=True)
+                self.mix_outputs = []
+                if self.single_graph:
+                    mix = self._create_mix_graph(mix_dir)
+                else:
+                    mix = await self._agather(
+                        lambda track: self._acreate_mix_segment(track, mix_dir),
+                        self.definition["mix"],
+                        "segment",
+                    )
+                    self.mix_files = [
+                        os.path.join(mix_dir, "{0}.wav".format(track["name"]))
+                        for track in self.definition["mix"]
+                    ]
+                self.mix = ffmpeg.filter(mix, "concat", n=len(mix), v=0, a=1)
+            with self.tracer.span("render mix"):
+                await self._arun(*self._render_outputs())
+            with self.tracer.span("cleanup"):
+                self._cleanup()
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            for task in self.decodes.values():
+                task.cancel()
+            await asyncio.gather(*self.decodes.values(), return_exceptions=True)
+            if cancelled and self.keep_tempfiles == False:
+                shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            if self.batch == None:
+                self.tracer.save()
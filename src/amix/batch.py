@@ -0,0 +1,156 @@
+import itertools
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .amix import Amix, _Clip
+from .trace import Tracer
+
+_logger = logging.getLogger(__name__)
+
+
+def data_matrix(matrix):
+    """
+    Expands "key=value1,value2" assignments to every combination of "key=value" data.
+    """
+
+    assignments = []
+    for m in matrix:
+        key, values = m.split("=", 1)
+        assignments.append(["{0}={1}".format(key, v) for v in values.split(",")])
+    return [list(data) for data in itertools.product(*assignments)]
+
+
+class Batch:
+    """
+    Renders many amix definitions in one process, sharing clip probes, decoded
+    clips and identical part and segment renders between them.
+    """
+
+    def __init__(self, output, jobs=1, keep_tempfiles=False, trace=None):
+        """
+        Creates a batch writing to output, running up to jobs ffmpeg processes at once.
+        """
+
+        self.output = output
+        self.tmp_dir = os.path.join(output, "tmp")
+        self.jobs = jobs if jobs > 0 else os.cpu_count()
+        self.keep_tempfiles = keep_tempfiles
+        self.semaphore = threading.BoundedSemaphore(self.jobs)
+        self.tracer = Tracer(trace)
+        self.lock = threading.Lock()
+        self.clips = {}
+        self.renders = {}
+        self.buffers = {}
+        self.files = {}
+        self.render_locks = {}
+        self.mixes = []
+
+    def create(self, config, output=None, **kwargs):
+        """
+        Creates an amix definition in the batch, see :func:`Amix.create`.
+        """
+
+        amix = Amix.create(
+            config, output if output else self.output, batch=self, **kwargs
+        )
+        self.mixes.append(amix)
+        return amix
+
+    def clip(self, name, path, load):
+        """
+        Returns the shared clip of path, loading it only once.
+        """
+
+        file = os.path.realpath(path)
+        with self.lock:
+            if file not in self.clips:
+                self.clips[file] = _Clip(name, path)
+            clip = self.clips[file]
+        with clip.lock:
+            if clip.loaded == None or clip.loaded != clip.identity():
+                load(clip)
+        return clip
+
+    def render(self, key, filename, render):
+        """
+        Renders filename once per key, later renders are copied.
+        Returns whether filename was rendered.
+        """
+
+        with self.lock:
+            lock = self.render_locks.setdefault(key, threading.Lock())
+        with lock:
+            rendered = self.renders.get(key)
+            # a file may have been rendered again with other inputs since
+            if (
+                rendered != None
+                and self.files.get(rendered) == key
+                and os.path.exists(rendered)
+            ):
+                if rendered != filename:
+                    _logger.info(
+                        'Using batch render "{0}" for "{1}"'.format(rendered, filename)
+                    )
+                    shutil.copyfile(rendered, filename)
+                    self.files[filename] = key
+                return False
+            render()
+            self.renders[key] = filename
+            self.files[filename] = key
+            return True
+
+    def buffer(self, key, render):
+        """
+        Renders data in memory once per key, later renders share it.
+        """
+
+        with self.lock:
+            lock = self.render_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.buffers:
+                self.buffers[key] = render()
+            return self.buffers[key]
+
+    def _run_mixes(self):
+        """
+        Renders the mixes, errors are reported per mix.
+        """
+
+        Path(self.tmp_dir).mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(amix.run) for amix in self.mixes]
+
+        errors = []
+        for amix, future in zip(self.mixes, futures):
+            try:
+                future.result()
+            except Exception as e:
+                _logger.error(
+                    'Error while processing mix "{0}": {1}'.format(amix.name, e)
+                )
+                errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _cleanup(self):
+        """
+        Cleans up the shared temporary files and writes the trace.
+        """
+
+        if self.keep_tempfiles == False:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.tracer.save()
+
+    def run(self):
+        """
+        Renders all mixes of the batch.
+        """
+
+        try:
+            self._run_mixes()
+        finally:
+            self._cleanup()
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+import ffmpeg
+
+_logger = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    """
+    Returns the per user cache directory of amix.
+    """
+
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "amix"
+    )
+
+
+class RenderCache:
+    """
+    Content addressed cache of rendered audio files with LRU eviction.
+    """
+
+    def __init__(self, path, size=1024):
+        """
+        Creates a render cache in path, limited to size megabytes.
+        """
+
+        self.path = path
+        self.size = size * 1024 * 1024
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(data):
+        """
+        Hashes JSON serializable render inputs to a cache key.
+        """
+
+        return hashlib.sha1(
+            json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, "{0}.wav".format(key))
+
+    def get(self, key, filename):
+        """
+        Copies the cached file for key to filename, returns whether it was a hit.
+        """
+
+        cached = self._filename(key)
+        try:
+            shutil.copyfile(cached, filename)
+            os.utime(cached)
+        except FileNotFoundError:
+            return False
+        _logger.info('Using cached file "{0}" for "{1}"'.format(cached, filename))
+        return True
+
+    def put(self, key, filename):
+        """
+        Stores filename as the cached file for key.
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+        cached = self._filename(key)
+        tmp_filename = "{0}.{1}.tmp".format(cached, threading.get_ident())
+        shutil.copyfile(filename, tmp_filename)
+        os.replace(tmp_filename, cached)
+        self._evict()
+
+    def read(self, key):
+        """
+        Returns the contents of the cached file for key, or None if it isn't cached.
+        """
+
+        cached = self._filename(key)
+        try:
+            with open(cached, "rb") as f:
+                data = f.read()
+            os.utime(cached)
+        except FileNotFoundError:
+            return None
+        _logger.info('Using cached file "{0}"'.format(cached))
+        return data
+
+    def write(self, key, data):
+        """
+        Stores data as the cached file for key.
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+        cached = self._filename(key)
+        tmp_filename = "{0}.{1}.tmp".format(cached, threading.get_ident())
+        with open(tmp_filename, "wb") as f:
+            f.write(data)
+        os.replace(tmp_filename, cached)
+        self._evict()
+
+    def _evict(self):
+        """
+        Removes least recently used files until the cache fits its size.
+        """
+
+        with self.lock:
+            entries = [
+                e
+                for e in os.scandir(self.path)
+                if e.is_file() and e.name.endswith(".wav")
+            ]
+            entries.sort(key=lambda e: e.stat().st_mtime)
+            total = sum([e.stat().st_size for e in entries])
+            for e in entries:
+                if total <= self.size:
+                    break
+                _logger.debug('Evicting cached file "{0}"'.format(e.path))
+                total -= e.stat().st_size
+                try:
+                    os.remove(e.path)
+                except FileNotFoundError:
+                    pass
+
+
+class ProbeCache:
+    """
+    Persistent cache of clip probes, keyed by real path, size and mtime, and
+    index of the clip files in folders, keyed by real path and mtime.
+    """
+
+    keys = ("duration", "sample_rate", "channels", "codec_name")
+
+    def __init__(self, filename):
+        """
+        Creates a probe cache stored in filename.
+        """
+
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.probes = None
+        self.changed = {}
+        self.dirs = None
+        self.changed_dirs = {}
+
+    def _read(self, section="probes"):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)[section]
+        except (FileNotFoundError, ValueError, KeyError):
+            return {}
+
+    def get(self, file):
+        """
+        Returns the cached probe of file if it is still valid, otherwise None.
+        """
+
+        file = os.path.realpath(file)
+        stat = os.stat(file)
+        with self.lock:
+            if self.probes == None:
+                self.probes = self._read()
+            entry = self.probes.get(file)
+        if (
+            entry
+            and entry["size"] == stat.st_size
+            and entry["mtime"] == stat.st_mtime_ns
+        ):
+            return entry["probe"]
+        return None
+
+    def probe(self, file, probe=ffmpeg.probe):
+        """
+        Probes the first stream of file, using the cache if it is still valid.
+        """
+
+        file = os.path.realpath(file)
+        cached = self.get(file)
+        if cached != None:
+            return cached
+
+        stat = os.stat(file)
+        stream = probe(file)["streams"][0]
+        probe = {k: stream[k] for k in self.keys if k in stream}
+        with self.lock:
+            self.probes[file] = self.changed[file] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "probe": probe,
+            }
+        return probe
+
+    def listing(self, dirname, mtime):
+        """
+        Returns the indexed entries of a folder if its mtime didn't change,
+        otherwise None.
+        """
+
+        dirname = os.path.realpath(dirname)
+        with self.lock:
+            if self.dirs == None:
+                self.dirs = self._read("dirs")
+            entry = self.dirs.get(dirname)
+        if entry and entry["mtime"] == mtime:
+            return entry["entries"]
+        return None
+
+    def store_listing(self, dirname, mtime, entries):
+        """
+        Indexes the entries of a folder, as listed at mtime.
+        """
+
+        dirname = os.path.realpath(dirname)
+        with self.lock:
+            if self.dirs == None:
+                self.dirs = self._read("dirs")
+            self.dirs[dirname] = self.changed_dirs[dirname] = {
+                "mtime": mtime,
+                "entries": entries,
+            }
+
+    def save(self):
+        """
+        Merges new probes and folder entries into the cache file.
+        """
+
+        with self.lock:
+            if len(self.changed) == 0 and len(self.changed_dirs) == 0:
+                return
+            probes = self._read()
+            probes.update(self.changed)
+            dirs = self._read("dirs")
+            dirs.update(self.changed_dirs)
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp_filename = "{0}.{1}.tmp".format(self.filename, os.getpid())
+            with open(tmp_filename, "w") as f:
+                json.dump({"probes": probes, "dirs": dirs}, f)
+            os.replace(tmp_filename, self.filename)
+            self.probes = probes
+            self.dirs = dirs
+            self.changed = {}
+            self.changed_dirs = {}
@@ -5,14 +5,26 @@ import sys
 
 from amix import __version__
 
-from .amix import Amix
-
 __author__ = "Sebastian Krüger"
 __copyright__ = "Sebastian Krüger"
 __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
+
+def _bar_range(value):
+    """
+    Parses a range of bars like "90-110"
+    """
+    try:
+        start, end = [float(x) for x in value.split("-")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            '"{0}" is not a range of bars like "90-110"'.format(value)
+        )
+    return start, end
+
+
 # ---- CLI ----
 # The functions defined in this section are wrappers around the main Python
 # API allowing them to be called directly from the terminal as a CLI
@@ -61,6 +73,12 @@ class CLI:
             nargs="*",
             default=["clips"],
         )
+        parser.add_argument(
+            "-r",
+            "--recursive",
+            help="Search clip folders recursively",
+            action="store_true",
+        )
         parser.add_argument(
             "-a",
             "--alias",
@@ -87,6 +105,111 @@ class CLI:
             help="Create parts from clips",
             action="store_true",
         )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            help="Number of parts and segments rendered in parallel, 0 for all CPUs",
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            "--no-cache",
+            dest="cache",
+            help="Don't cache clip probes and rendered parts and segments",
+            action="store_false",
+        )
+        parser.add_argument(
+            "--cache_dir", help="Directory of the cache, can be shared by projects"
+        )
+        parser.add_argument(
+            "--index",
+            help="Index clip folders in the cache, unchanged folders are listed from it "
+            "(needs the cache)",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--cache_size",
+            help="Size limit of the render cache in megabytes",
+            type=int,
+            default=1024,
+        )
+        parser.add_argument(
+            "--optimize",
+            help="Drop filters without effect, fold volumes and render parts "
+            "sharing filtered clips together",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--single_graph",
+            help="Render the whole mix with a single ffmpeg process",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-f",
+            "--format",
+            help='Output format of the mix, like e.g. "wav", "flac", "mp3" or "opus", '
+            'defaults to "wav" and "mp3" for previews',
+        )
+        parser.add_argument(
+            "--codec", help='Audio codec of the mix, like e.g. "libopus"'
+        )
+        parser.add_argument(
+            "--stdout",
+            help="Stream the mix to stdout instead of writing it to the output folder",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--preview",
+            help="Render a fast draft of the mix in mono at a low sample rate, "
+            "with the same structure and timing",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--segments",
+            help='Render only these mix segments, like e.g. "segment3,segment4"',
+            type=lambda value: value.split(","),
+        )
+        parser.add_argument(
+            "--bars",
+            help='Render only a range of bars of the mix, like e.g. "90-110"',
+            type=_bar_range,
+        )
+        parser.add_argument(
+            "-e",
+            "--engine",
+            help="Engine mixing the clips",
+            choices=["ffmpeg", "numpy"],
+            default="ffmpeg",
+        )
+        parser.add_argument(
+            "--transport",
+            help="Pass decoded clips, parts and segments between ffmpeg processes "
+            "as files or through pipes in memory",
+            choices=["file", "pipe"],
+            default="file",
+        )
+        parser.add_argument(
+            "-b",
+            "--batch",
+            help="Render several definition files in one process",
+            nargs="+",
+        )
+        parser.add_argument(
+            "-m",
+            "--matrix",
+            help='Render every combination of variables set like "key=value1,value2"',
+            nargs="+",
+        )
+        parser.add_argument(
+            "-w",
+            "--watch",
+            help="Render again whenever the definition or the clips change",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--trace",
+            help="Write a trace of the render stages in the Chrome trace format",
+        )
         parser.add_argument(
             "-y",
             "--yes",
@@ -96,17 +219,71 @@ class CLI:
 
         return parser.parse_args(args)
 
-    def setup_logging(self, loglevel):
+    def parse_validate_args(self, args):
+        """
+        Parse command line parameters of the validate command
+        """
+        parser = argparse.ArgumentParser(
+            prog="amix validate",
+            description="Validate amix definition files without rendering",
+        )
+        parser.add_argument(
+            "-v",
+            "--verbose",
+            dest="loglevel",
+            help="set loglevel to INFO",
+            action="store_const",
+            const=logging.INFO,
+        )
+        parser.add_argument(
+            "definition",
+            help="Amix definition files",
+            nargs="*",
+            default=[os.path.join(os.getcwd(), "amix.yml")],
+        )
+        parser.add_argument(
+            "-c",
+            "--clip",
+            help='Amix input audio clip file or folder ("*.mp3", "*.wav", "*.aif")',
+            nargs="*",
+            default=["clips"],
+        )
+        parser.add_argument(
+            "-r",
+            "--recursive",
+            help="Search clip folders recursively",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-a",
+            "--alias",
+            help="Alias name for audio clip file",
+            nargs="*",
+            default=[],
+        )
+        parser.add_argument(
+            "-d", "--data", help="Variables set to fill definition", nargs="*"
+        )
+        parser.add_argument(
+            "-p",
+            "--parts_from_clips",
+            help="Create parts from clips",
+            action="store_true",
+        )
+        return parser.parse_args(args)
+
+    def setup_logging(self, loglevel, stream=sys.stdout):
         """
         Setup basic logging
 
         Args:
         loglevel (int): minimum loglevel for emitting messages
+        stream (file): stream to emit messages to
         """
         logformat = "[%(asctime)s] %(levelname)s - %(name)s - %(message)s"
         logging.basicConfig(
             level=loglevel,
-            stream=sys.stdout,
+            stream=stream,
             format=logformat,
             datefmt="%Y-%m-%d %H:%M:%S",
         )
@@ -115,9 +292,21 @@ class CLI:
         """
         Wrapper allowing :func:`amix` to be called with string arguments in a CLI fashion
         """
+        if len(args) > 0 and args[0] == "validate":
+            self.validate(args[1:])
+            return
+
         args = self.parse_args(args)
-        self.setup_logging(args.loglevel)
+        # keep stdout clean when the mix is streamed there
+        self.setup_logging(args.loglevel, sys.stderr if args.stdout else sys.stdout)
         _logger.info("Starting amix")
+        # imported here, so --version and validate don't pay for it
+        from .amix import Amix
+
+        if args.batch or args.matrix or args.watch:
+            self.run_batch(args)
+            _logger.info("Done amix")
+            return
 
         Amix.create(
             args.definition,
@@ -130,10 +319,105 @@ class CLI:
             args.alias,
             args.name,
             args.parts_from_clips,
+            recursive=args.recursive,
+            index=args.index,
+            jobs=args.jobs,
+            cache=args.cache,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            single_graph=args.single_graph,
+            optimize=args.optimize,
+            format=args.format,
+            codec=args.codec,
+            stdout=args.stdout,
+            preview=args.preview,
+            segments=args.segments,
+            bars=args.bars,
+            engine=args.engine,
+            transport=args.transport,
+            trace=args.trace,
         ).run()
 
         _logger.info("Done amix")
 
+    def run_batch(self, args):
+        """
+        Renders every definition file and variable combination in one batch
+        """
+        from .batch import Batch, data_matrix
+        from .watch import Watch
+
+        batch = (Watch if args.watch else Batch)(
+            args.output, args.jobs, args.keep_tempfiles, args.trace
+        )
+        for definition in args.batch if args.batch else [args.definition]:
+            for data in data_matrix(args.matrix) if args.matrix else [None]:
+                output = args.output
+                if data != None:
+                    # every variant gets its own folder, as they share the mix name
+                    output = os.path.join(
+                        output, "_".join([d.replace("=", "-") for d in data])
+                    )
+                    data = (args.data if args.data else []) + data
+                else:
+                    data = args.data
+                batch.create(
+                    definition,
+                    output,
+                    yes=args.yes,
+                    loglevel=args.loglevel,
+                    keep_tempfiles=args.keep_tempfiles,
+                    clip=args.clip,
+                    data=data,
+                    alias=args.alias,
+                    name=args.name,
+                    parts_from_clips=args.parts_from_clips,
+                    recursive=args.recursive,
+                    index=args.index,
+                    jobs=args.jobs,
+                    cache=args.cache,
+                    cache_dir=args.cache_dir,
+                    cache_size=args.cache_size,
+                    single_graph=args.single_graph,
+                    optimize=args.optimize,
+                    format=args.format,
+                    codec=args.codec,
+                    stdout=args.stdout,
+                    preview=args.preview,
+                    segments=args.segments,
+                    bars=args.bars,
+                    engine=args.engine,
+                    transport=args.transport,
+                )
+        batch.run()
+
+    def validate(self, args):
+        """
+        Validates definition files and their references, without running ffmpeg
+        """
+        args = self.parse_validate_args(args)
+        self.setup_logging(args.loglevel)
+        from .amix import Amix
+
+        valid = True
+        for definition in args.definition:
+            try:
+                Amix.create(
+                    definition,
+                    os.getcwd(),
+                    clip=args.clip,
+                    data=args.data,
+                    alias=args.alias,
+                    parts_from_clips=args.parts_from_clips,
+                    recursive=args.recursive,
+                ).validate()
+                print('Definition "{0}" is valid'.format(definition))
+            except Exception as e:
+                print('Definition "{0}" is invalid: {1}'.format(definition, e))
+                valid = False
+        if not valid:
+            sys.exit(1)
+
 
 def run():
     """
@@ -0,0 +1,103 @@
+import fnmatch
+import logging
+import os
+
+_logger = logging.getLogger(__name__)
+
+# glob patterns of clip files, in the order clips are discovered
+patterns = ("*.mp3", "*.wav", "*.aif")
+
+
+def _stat_entries(dirname, entries):
+    """
+    Updates the size and modification time of indexed clip files, as files
+    overwritten in place don't change the mtime of their folder. Returns
+    None if a file is gone.
+    """
+
+    updated = []
+    for name, is_dir, size, mtime in entries:
+        if not is_dir:
+            try:
+                stat = os.stat(os.path.join(dirname, name))
+            except FileNotFoundError:
+                return None
+            size, mtime = stat.st_size, stat.st_mtime
+        updated.append([name, is_dir, size, mtime])
+    return updated
+
+
+def _entries(dirname, index=None):
+    """
+    Lists the clip files and sub folders of a folder with their size and
+    modification time, from the index if the folder didn't change.
+    """
+
+    mtime = os.stat(dirname).st_mtime_ns
+    if index != None:
+        indexed = index.listing(dirname, mtime)
+        entries = _stat_entries(dirname, indexed) if indexed != None else None
+        if entries != None:
+            if entries != indexed:
+                index.store_listing(dirname, mtime, entries)
+            return entries
+
+    _logger.debug('Scanning folder "{0}"'.format(dirname))
+    entries = []
+    with os.scandir(dirname) as it:
+        for entry in it:
+            # like glob, hidden files and folders are skipped
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                entries.append([entry.name, True, 0, 0])
+            elif entry.is_file() and any(
+                [fnmatch.fnmatch(entry.name, p) for p in patterns]
+            ):
+                stat = entry.stat()
+                entries.append([entry.name, False, stat.st_size, stat.st_mtime])
+    if index != None:
+        index.store_listing(dirname, mtime, entries)
+    return entries
+
+
+def folders(dirname, recursive=False):
+    """
+    Returns a folder and, if recursive, the sub folders discover scans.
+    """
+
+    dirnames = [dirname]
+    if recursive:
+        for root, dirs, files in os.walk(dirname):
+            # like discover, hidden folders are skipped
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            dirnames.extend([os.path.join(root, d) for d in dirs])
+    return dirnames
+
+
+def discover(dirname, recursive=False, index=None):
+    """
+    Returns the clip files in a folder, ordered by pattern and then by
+    modification time like sorted globs, scanning every folder only once.
+    """
+
+    files = []
+
+    def scan(dirname):
+        for name, is_dir, size, mtime in _entries(dirname, index):
+            path = os.path.join(dirname, name)
+            if not is_dir:
+                files.append((name, path, mtime))
+            elif recursive:
+                scan(path)
+
+    scan(dirname)
+    clips = []
+    for pattern in patterns:
+        clips.extend(
+            sorted(
+                [f for f in files if fnmatch.fnmatch(f[0], pattern)],
+                key=lambda f: f[2],
+            )
+        )
+    return [f[1] for f in clips]
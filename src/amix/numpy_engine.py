@@ -0,0 +1,282 @@
+import logging
+import math
+
+import ffmpeg
+import numpy as np
+
+from .amix import _PREVIEW_CHANNELS, _PREVIEW_SAMPLE_RATE, Amix
+from .cache import RenderCache
+
+_logger = logging.getLogger(__name__)
+
+
+def _fade_gain(curve, gain):
+    """
+    Calculates fade gains like the ffmpeg afade filter.
+    """
+
+    gain = np.clip(gain, 0, 1)
+    if curve == "qsin":
+        return np.sin(gain * math.pi / 2)
+    elif curve == "iqsin":
+        return 0.636943 * np.arcsin(gain)
+    elif curve == "esin":
+        return 1 - np.cos(math.pi / 4 * ((2 * gain - 1) ** 3 + 1))
+    elif curve == "hsin":
+        return (1 - np.cos(gain * math.pi)) / 2
+    elif curve == "ihsin":
+        return 0.318471 * np.arccos(1 - 2 * gain)
+    elif curve == "exp":
+        return np.exp(-11.512925464970227 * (1 - gain))
+    elif curve == "log":
+        with np.errstate(divide="ignore"):
+            return np.clip(1 + 0.2 * np.log10(gain), 0, 1)
+    elif curve == "par":
+        return 1 - np.sqrt(1 - gain)
+    elif curve == "ipar":
+        return 1 - (1 - gain) * (1 - gain)
+    elif curve == "qua":
+        return gain * gain
+    elif curve == "cub":
+        return gain**3
+    elif curve == "squ":
+        return np.sqrt(gain)
+    elif curve == "cbr":
+        return np.cbrt(gain)
+    elif curve == "dese":
+        return np.where(
+            gain <= 0.5, np.cbrt(2 * gain) / 2, 1 - np.cbrt(2 * (1 - gain)) / 2
+        )
+    elif curve == "desi":
+        return np.where(gain <= 0.5, (2 * gain) ** 3 / 2, 1 - (2 * (1 - gain)) ** 3 / 2)
+    elif curve == "losi":
+        a = 1 / (1 - 0.787) - 1
+        A = 1 / (1 + np.exp(-((gain - 0.5) * a * 2)))
+        B = 1 / (1 + math.exp(a))
+        C = 1 / (1 + math.exp(-a))
+        return (A - B) / (C - B)
+    elif curve == "sinc":
+        x = math.pi * (1 - gain)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(gain >= 1, 1, np.sin(x) / x)
+    elif curve == "isinc":
+        x = math.pi * gain
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(gain <= 0, 0, 1 - np.sin(x) / x)
+    elif curve == "nofade":
+        # like afade, silent before a fade in and after a fade out
+        return np.where(gain <= 0, 0, 1)
+    return gain
+
+
+class NumpyAmix(Amix):
+    """
+    Amix engine mixing decoded clips in process with NumPy.
+    ffmpeg is only used for decoding, encoding and the rubberband filter.
+    """
+
+    engine = "numpy"
+    fan_out_parts = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.single_graph = False
+
+    def _load_clips(self):
+        """
+        Loads clips and chooses the sample format to mix in.
+        """
+
+        super()._load_clips()
+        if self.preview:
+            self.sample_rate = _PREVIEW_SAMPLE_RATE
+            self.channels = _PREVIEW_CHANNELS
+            return
+        self.sample_rate = max(
+            [int(c.probe["sample_rate"]) for c in self.clips.values()] + [1]
+        )
+        self.channels = max(
+            [int(c.probe["channels"]) for c in self.clips.values()] + [1]
+        )
+
+    def _pcm(self, stream, input=None):
+        """
+        Runs a stream to raw float samples.
+        """
+
+        out, _ = self._ffmpeg(
+            stream.output(
+                "pipe:",
+                format="f32le",
+                ac=self.channels,
+                ar=self.sample_rate,
+                loglevel=self.loglevel,
+            ),
+            input=input,
+            capture_stdout=True,
+        )
+        return np.frombuffer(out, dtype=np.float32).reshape(-1, self.channels)
+
+    def _pipe(self):
+        """
+        Creates an ffmpeg input reading raw float samples from stdin.
+        """
+
+        return ffmpeg.input(
+            "pipe:", format="f32le", ac=self.channels, ar=self.sample_rate
+        )
+
+    def _count(self, seconds):
+        return int(round(seconds * self.sample_rate))
+
+    def _filter(self, samples, filter_type, kwargs, start=0):
+        """
+        Applies a resolved filter to samples beginning at start seconds.
+        """
+
+        if filter_type == "rubberband":
+            return np.array(
+                self._pcm(
+                    self._pipe().filter(filter_type, **kwargs),
+                    samples.astype(np.float32).tobytes(),
+                ),
+                dtype=np.float64,
+            )
+
+        t = np.arange(len(samples)) / self.sample_rate + start
+        if filter_type == "volume":
+            gain = np.full(len(samples), kwargs["volume"])
+        elif filter_type == "afade":
+            start = kwargs["start_time"]
+            duration = kwargs["duration"]
+            if kwargs["type"] == "in":
+                gain = _fade_gain(kwargs["curve"], (t - start) / duration)
+            else:
+                gain = _fade_gain(kwargs["curve"], (start + duration - t) / duration)
+        else:
+            raise Exception('Filter "{0}" does not exist'.format(filter_type))
+
+        if "enable" in kwargs:
+            # "between(t,from,to)" or "gte(t,from)" as built by _parse_filter
+            enable = kwargs["enable"]
+            window = [float(x) for x in enable[enable.index(",") + 1 : -1].split(",")]
+            mask = t >= window[0]
+            if len(window) > 1:
+                mask &= t <= window[1]
+            gain = np.where(mask, gain, 1)
+        return samples * gain[:, None]
+
+    def _apply_filters(self, samples, list, start=0):
+        """
+        Applys filters to samples beginning at start seconds.
+        """
+        for filter_type, kwargs in self._resolve_filters(list):
+            samples = self._filter(samples, filter_type, kwargs, start)
+        return samples
+
+    def _mix(self, samples, weights):
+        """
+        Sums weighted samples, padding them to the longest.
+        """
+
+        mix = np.zeros((max([len(x) for x in samples]), self.channels))
+        for x, weight in zip(samples, weights.split(" ")):
+            mix[: len(x)] += x * float(weight)
+        return mix
+
+    def _hoist_samples(self, clip, samples, list):
+        """
+        Applies hoisted filters once to the samples of a source clip, per
+        sample format as batches share clips between previews and full renders.
+        """
+        key = RenderCache.key(
+            [self._resolve_filters(list), self.sample_rate, self.channels]
+        )
+        with clip.lock:
+            if key not in clip.hoisted:
+                clip.hoisted[key] = self._apply_filters(samples, list)
+        return clip.hoisted[key]
+
+    def _create_mix_part(self, part, bars_global=None):
+        """
+        Creates a mix part.
+        """
+        name = part["name"]
+        _logger.info('Creating mix part "{0}"'.format(name))
+        clips, weights = self._layout_part(part, bars_global)
+        start = part["window"][0] if "window" in part else 0
+
+        samples = []
+        for x in clips:
+            clip = x["clip"].pcm(
+                self.decode_dir,
+                self.loglevel,
+                self.sample_rate,
+                self.channels,
+                self._ffmpeg,
+            )
+            if len(x["hoisted"]) > 0:
+                clip = self._hoist_samples(x["clip"], clip, x["hoisted"])
+            clip_time = x["clip_time"]
+            pad = 0
+            if x["offset"] > 0:
+                pad = self._count(x["offset"] * self.bar_time)
+                clip_time += x["offset"] * self.bar_time
+            # slice the memory mapped samples before anything is copied
+            length = self._count(clip_time)
+            clip = clip[:length]
+            pad = min(pad, length - len(clip))
+            if pad > 0:
+                clip = np.concatenate(
+                    [clip, np.zeros((pad, self.channels), clip.dtype)]
+                )
+            clip = np.tile(clip, (int(x["loop"]) + 1, 1))
+            if "window" in part:
+                clip = clip[self._count(start) : self._count(part["window"][1])]
+
+            if len(x["filters"]) > 0:
+                clip = self._apply_filters(clip, x["filters"], start)
+
+            samples.append(clip)
+
+        clip = self._mix(samples, weights)
+        filters = self._split_filters(part.get("filters", []))[1]
+        if len(filters) > 0:
+            clip = self._apply_filters(clip, filters, start)
+        self.mix_parts[name] = clip
+
+    def _create_mix_segment(self, track, mix_dir):
+        """
+        Creates a mix segment.
+        """
+        _logger.info('Creating mix segment "{0}"'.format(track["name"]))
+        clip = self._mix(
+            [self.mix_parts[x["name"]] for x in track["parts"]],
+            self._segment_weights(track),
+        )
+        if "filters" in track:
+            clip = self._apply_filters(
+                clip, track["filters"], track["window"][0] if "window" in track else 0
+            )
+        return clip
+
+    def _create_mix(self):
+        """
+        Creates the mix data.
+        """
+        _logger.info("Creating mix")
+        self.mix_outputs = []
+        self.samples_mix = np.concatenate(
+            self._map(
+                lambda track: self._create_mix_segment(track, None),
+                self.definition["mix"],
+                "segment",
+            )
+        )
+        self.mix = self._pipe()
+
+    def _run(self, outputs, input=None):
+        """
+        Encodes the mix, feeding the samples through stdin.
+        """
+        super()._run(outputs, self.samples_mix.astype(np.float32).tobytes())
@@ -0,0 +1,270 @@
+import io
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import ffmpeg
+
+from .amix import Amix, _wav_format
+
+_logger = logging.getLogger(__name__)
+
+
+def _fix_wav(data):
+    """
+    Sets the sizes in the header of a WAV file written to a pipe, which ffmpeg
+    can't seek back to.
+    """
+
+    data = bytearray(data)
+    data[4:8] = struct.pack("<I", len(data) - 8)
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk = bytes(data[offset : offset + 4])
+        if chunk == b"data":
+            data[offset + 4 : offset + 8] = struct.pack("<I", len(data) - offset - 8)
+            break
+        size = struct.unpack("<I", data[offset + 4 : offset + 8])[0]
+        offset += 8 + size + size % 2
+    return bytes(data)
+
+
+def _write(path, data):
+    try:
+        with open(path, "wb") as f:
+            f.write(data)
+    except BrokenPipeError:
+        pass
+
+
+@contextmanager
+def _serve(buffers):
+    """
+    Serves buffers through named pipes, each to be read once by ffmpeg.
+    """
+
+    dirname = tempfile.mkdtemp(prefix="amix-")
+    threads = []
+    paths = []
+    try:
+        for i, data in enumerate(buffers):
+            path = os.path.join(dirname, "{0}.wav".format(i))
+            os.mkfifo(path)
+            paths.append(path)
+            thread = threading.Thread(target=_write, args=(path, data), daemon=True)
+            thread.start()
+            threads.append(thread)
+        yield paths
+    finally:
+        for path, thread in zip(paths, threads):
+            while thread.is_alive():
+                # unblocks writers of pipes ffmpeg didn't read to the end
+                try:
+                    os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                thread.join(0.1)
+        shutil.rmtree(dirname, ignore_errors=True)
+
+
+class PipeAmix(Amix):
+    """
+    Amix passing decoded clips, parts and segments between ffmpeg processes in
+    memory and through named pipes instead of files. Files are only written for
+    kept temp files and the render cache.
+    """
+
+    transport = "pipe"
+    # parts are captured from stdout one at a time
+    fan_out_parts = False
+
+    def _make_dirs(self):
+        """
+        Creates the output folders, only the temporary one unless temp files are kept.
+        """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        if self.keep_tempfiles:
+            super()._make_dirs()
+
+    def _capture(self, stream):
+        """
+        Runs a stream to an in memory WAV file.
+        """
+        out, _ = self._ffmpeg(
+            self._output([(stream, "pipe:", dict(format="wav"))]),
+            capture_stdout=True,
+        )
+        return _fix_wav(out)
+
+    def _read(self, key):
+        """
+        Reads a rendered WAV file from the cache.
+        """
+        if self.cache == None:
+            return None
+        return self.cache.read(key)
+
+    def _write(self, key, data, filename):
+        """
+        Writes a rendered WAV file to the cache, and to filename if temp files are kept.
+        """
+        if self.cache != None:
+            self.cache.write(key, data)
+        if self.keep_tempfiles:
+            with open(filename, "wb") as f:
+                f.write(data)
+
+    def _buffer(self, clip):
+        """
+        Decodes a clip once into memory.
+        """
+        extension = self._decode_format()[0]
+        with clip.lock:
+            if extension not in clip.buffers:
+                _logger.info('Decoding clip "{0}" into memory'.format(clip.name))
+                clip.buffers[extension] = self._capture(self._clip_input(clip))
+        return clip.buffers[extension]
+
+    def _hoist_buffer(self, clip, list):
+        """
+        Applies hoisted filters once to the source clip into memory, keyed like
+        hoisted files.
+        """
+        key = self._hoist_key(clip, list)
+        with clip.lock:
+            if key not in clip.buffers:
+                data = self._read(key)
+                if data == None:
+                    _logger.info(
+                        'Applying hoisted filters to clip "{0}" in memory'.format(
+                            clip.name
+                        )
+                    )
+                    data = self._capture(
+                        self._apply_filters(self._clip_input(clip), list)
+                    )
+                    self._write(
+                        key, data, os.path.join(self.decode_dir, "{0}.wav".format(key))
+                    )
+                clip.buffers[key] = data
+        return clip.buffers[key]
+
+    def _source_buffer(self, clip, hoisted):
+        """
+        Returns the decoded clip in memory, with its hoisted filters applied.
+        """
+        if len(self._resolve_filters(hoisted)) > 0:
+            return self._hoist_buffer(clip, hoisted)
+        return self._buffer(clip)
+
+    def _render_buffer(self, key, filename, render):
+        """
+        Renders a WAV file into memory with render, unless it is cached or
+        rendered by the batch.
+        """
+        data = self._read(key)
+        if data == None:
+            if self.batch != None:
+                data = self.batch.buffer(key, render)
+            else:
+                data = render()
+            self._write(key, data, filename)
+        return data
+
+    def _create_mix_part(self, part, bars_global=None):
+        """
+        Creates a mix part in memory.
+        """
+        name = part["name"]
+        _logger.info('Creating mix part "{0}"'.format(name))
+        clips, weights = self._layout_part(part, bars_global)
+        key = self._part_key(part, clips, weights)
+        self.mix_part_keys[name] = key
+
+        def source(clip, hoisted):
+            return (clip, tuple([f["name"] for f in hoisted]))
+
+        def render():
+            sources = {}
+            for x in clips:
+                sources.setdefault(source(x["clip"], x["hoisted"]), x["hoisted"])
+            with _serve(
+                [self._source_buffer(c, h) for (c, _), h in sources.items()]
+            ) as paths:
+                inputs = dict(zip(sources, [ffmpeg.input(p) for p in paths]))
+                clip = self._build_part(
+                    part,
+                    clips,
+                    weights,
+                    lambda c, hoisted: inputs[source(c, hoisted)],
+                )
+                return self._capture(clip)
+
+        self.mix_parts[name] = self._render_buffer(
+            key, os.path.join(self.parts_dir, "{0}.wav".format(name)), render
+        )
+
+    def _create_mix_segment(self, track, mix_dir):
+        """
+        Creates a mix segment in memory.
+        """
+        weights = self._segment_weights(track)
+        key = self._segment_key(track, weights)
+
+        def render():
+            names = []
+            for x in track["parts"]:
+                if x["name"] not in names:
+                    names.append(x["name"])
+            with _serve([self.mix_parts[n] for n in names]) as paths:
+                inputs = dict(zip(names, [ffmpeg.input(p) for p in paths]))
+                clip = self._build_segment(
+                    track, [inputs[x["name"]] for x in track["parts"]], weights
+                )
+                return self._capture(clip)
+
+        return self._render_buffer(
+            key, os.path.join(mix_dir, "{0}.wav".format(track["name"])), render
+        )
+
+    def _create_mix(self):
+        """
+        Creates the mix segments in memory.
+        """
+        if self.single_graph:
+            return super()._create_mix()
+
+        _logger.info("Creating mix")
+        mix_dir = os.path.join(self.mix_dir, self.definition["name"])
+        if self.keep_tempfiles:
+            os.makedirs(mix_dir, exist_ok=True)
+        self.mix_outputs = []
+        self.mix_segments = self._map(
+            lambda track: self._create_mix_segment(track, mix_dir),
+            self.definition["mix"],
+            "segment",
+        )
+
+    def _mix_formats(self):
+        """
+        Returns the WAV formats of the mix segments in memory.
+        """
+        return [_wav_format(io.BytesIO(data)) for data in self.mix_segments]
+
+    def _render_mix(self):
+        """
+        Renders the mix to disc, reading the segments through named pipes.
+        """
+        if self.single_graph:
+            return super()._render_mix()
+
+        with _serve(self.mix_segments) as paths:
+            self.mix = ffmpeg.filter(
+                [ffmpeg.input(p) for p in paths], "concat", n=len(paths), v=0, a=1
+            )
+            self.mix_files = paths
+            super()._render_mix()
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import os
+import shlex
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """
+    Records spans in the Chrome trace event format, loadable by chrome://tracing
+    and Perfetto.
+    """
+
+    def __init__(self, filename=None):
+        """
+        Creates a tracer, which writes its spans to filename if given.
+        """
+
+        self.filename = filename
+        self.events = []
+        self.threads = {}
+        self.tasks = weakref.WeakKeyDictionary()
+        self.count = 0
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+
+    def _tid(self):
+        """
+        Returns the trace thread of the running asyncio task or thread. Tasks
+        share the thread of the event loop, but their spans overlap instead of
+        nesting, so every task gets its own.
+        """
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task != None:
+            threads, ident, name = self.tasks, task, task.get_name()
+        else:
+            threads = self.threads
+            ident = threading.get_ident()
+            name = threading.current_thread().name
+        with self.lock:
+            if ident not in threads:
+                threads[ident] = self.count
+                self.count += 1
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self.pid,
+                        "tid": threads[ident],
+                        "args": {"name": name},
+                    }
+                )
+            return threads[ident]
+
+    @contextmanager
+    def span(self, name, category="amix", **args):
+        """
+        Records the wall time of the enclosed block.
+        """
+
+        if self.filename == None:
+            yield
+            return
+
+        tid = self._tid()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.events.append(
+                    {
+                        "name": name,
+                        "cat": category,
+                        "ph": "X",
+                        "ts": (start - self.start) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": self.pid,
+                        "tid": tid,
+                        "args": args,
+                    }
+                )
+
+    def command(self, name, args):
+        """
+        Records a subprocess span carrying its command line.
+        """
+
+        return self.span(name, "subprocess", cmd=" ".join(shlex.quote(a) for a in args))
+
+    def save(self):
+        """
+        Writes the recorded spans.
+        """
+
+        if self.filename == None:
+            return
+        _logger.info('Writing trace to "{0}"'.format(self.filename))
+        with self.lock:
+            events = list(self.events)
+        with open(self.filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,99 @@
+import logging
+import os
+import time
+
+from .amix import Amix
+from .batch import Batch
+from .library import discover, folders
+
+_logger = logging.getLogger(__name__)
+
+
+class Watch(Batch):
+    """
+    Renders definitions again whenever they or their clips change. Clips stay
+    loaded and decoded, and only parts and segments with changed inputs are
+    rendered again.
+    """
+
+    def __init__(self, output, jobs=1, keep_tempfiles=False, trace=None, interval=1):
+        """
+        Creates a watch writing to output, polling for changes every interval seconds.
+        """
+
+        super().__init__(output, jobs, keep_tempfiles, trace)
+        self.interval = interval
+        self.definitions = []
+
+    def create(self, config, output=None, **kwargs):
+        """
+        Adds an amix definition to the watch, see :func:`Amix.create`.
+        """
+
+        self.definitions.append((config, output if output else self.output, kwargs))
+
+    def _files(self):
+        """
+        Returns the modification state of definitions, clip folders and clips.
+        """
+
+        paths = set()
+        for config, output, kwargs in self.definitions:
+            paths.add(config)
+            clip = kwargs.get("clip")
+            if clip == None:
+                clip = [os.path.dirname(config) + "/clips"]
+            recursive = kwargs.get("recursive", False)
+            for file in clip:
+                paths.add(file)
+                if os.path.isdir(file):
+                    paths.update(folders(file, recursive))
+                    paths.update(discover(file, recursive))
+        for amix in self.mixes:
+            paths.update([c["path"] for c in amix.definition["clips"]])
+
+        files = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                files[path] = None
+        return files
+
+    def _wait(self, files):
+        """
+        Waits until files change.
+        """
+
+        _logger.info("Waiting for changes")
+        while self._files() == files:
+            time.sleep(self.interval)
+
+    def run(self):
+        """
+        Renders all definitions, and again on every change until interrupted.
+        """
+
+        try:
+            while True:
+                self.mixes = []
+                try:
+                    for config, output, kwargs in self.definitions:
+                        self.mixes.append(
+                            Amix.create(config, output, batch=self, **kwargs)
+                        )
+                    files = self._files()
+                    self._run_mixes()
+                    _logger.info("Rendered mixes")
+                except Exception as e:
+                    _logger.error("Error while rendering: {0}".format(e))
+                    files = self._files()
+                # later renders replace the files of the previous ones
+                for config, output, kwargs in self.definitions:
+                    kwargs["yes"] = True
+                self._wait(files)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._cleanup()
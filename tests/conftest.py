@@ -7,4 +7,14 @@
     - https://docs.pytest.org/en/stable/writing_plugins.html
 """
 
-# import pytest
+import os
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(monkeypatch):
+    """Keep the amix cache inside the tests directory"""
+    monkeypatch.setenv(
+        "XDG_CACHE_HOME", os.path.join(os.path.dirname(__file__), "tmp", "cache")
+    )
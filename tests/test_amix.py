@@ -1,14 +1,25 @@
+import asyncio
 import glob
 import hashlib
 import io
+import json
 import logging
 import os
+import shutil
+import threading
+import time
+import wave
+from unittest import mock
 
+import ffmpeg
 import pytest
 import yaml
 from jsonschema import ValidationError
 
 from amix.amix import Amix
+from amix.batch import Batch, data_matrix
+from amix.library import discover
+from amix.watch import Watch
 
 __author__ = "Sebastian Krüger"
 __copyright__ = "Sebastian Krüger"
@@ -55,6 +66,901 @@ def test_run_cleanup():
     assert os.path.exists(tmp_dir) == True
 
 
+def test_run_decode_once():
+    """Test Amix().run decodes every clip once"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    test_name = "decode_once"
+    tmp_dir = os.path.join(output, test_name, "tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    Amix.create(
+        fixture, output, True, name=test_name, keep_tempfiles=True, cache=False
+    ).run()
+    assert len(os.listdir(tmp_dir)) == 2
+
+
+def test_run_jobs():
+    """Test Amix().run with parallel jobs"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    hashes = []
+    for jobs in [1, 4]:
+        test_name = "jobs{0}".format(jobs)
+        Amix.create(fixture, output, True, name=test_name, jobs=jobs).run()
+        hashes.append(
+            hashlib.sha1(
+                open(os.path.join(output, test_name + ".wav"), "rb").read()
+            ).hexdigest()
+        )
+
+    assert hashes[0] == hashes[1]
+
+
+def test_run_single_graph():
+    """Test Amix().run with a single filter graph"""
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    hashes = []
+    for single_graph in [False, True]:
+        fixture = os.path.join(os.path.dirname(__file__), "fixtures", "basic.yml")
+        test_name = "single_graph{0}".format(single_graph)
+        Amix.create(
+            fixture, output, True, name=test_name, single_graph=single_graph
+        ).run()
+        hashes.append(
+            hashlib.sha1(
+                open(os.path.join(output, test_name + ".wav"), "rb").read()
+            ).hexdigest()
+        )
+    assert hashes[0] == hashes[1]
+
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    test_name = "single_graph"
+    shutil.rmtree(os.path.join(output, test_name), ignore_errors=True)
+    Amix.create(
+        fixture, output, True, name=test_name, single_graph=True, keep_tempfiles=True
+    ).run()
+    assert os.path.exists(os.path.join(output, test_name + ".wav"))
+    assert len(os.listdir(os.path.join(output, test_name, "parts"))) == 5
+    assert len(os.listdir(os.path.join(output, test_name, "mix", test_name))) == 3
+    assert len(os.listdir(os.path.join(output, test_name, "tmp"))) == 0
+
+
+def test_run_pipe_transport():
+    """Test Amix().run passing intermediates through pipes"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    hashes = []
+    for transport in ["file", "pipe"]:
+        test_name = "transport_{0}".format(transport)
+        shutil.rmtree(os.path.join(output, test_name), ignore_errors=True)
+        Amix.create(
+            fixture, output, True, name=test_name, cache=False, transport=transport
+        ).run()
+        hashes.append(
+            hashlib.sha1(
+                open(os.path.join(output, test_name + ".wav"), "rb").read()
+            ).hexdigest()
+        )
+    assert hashes[0] == hashes[1]
+    assert not os.path.exists(os.path.join(output, test_name, "parts"))
+
+    # kept parts and cached renders are the same files as with file transport
+    test_name = "transport_pipe_keep"
+    cache_dir = os.path.join(output, test_name, "cache")
+    shutil.rmtree(os.path.join(output, test_name), ignore_errors=True)
+    Amix.create(
+        fixture,
+        output,
+        True,
+        name=test_name,
+        keep_tempfiles=True,
+        cache_dir=cache_dir,
+        transport="pipe",
+    ).run()
+    parts = os.path.join(output, test_name, "parts")
+    assert len(os.listdir(parts)) == 5
+    with wave.open(os.path.join(parts, "backbeat0.wav")) as w:
+        assert w.getnframes() > 0
+    assert len(glob.glob(os.path.join(cache_dir, "render", "*.wav"))) == 8
+    Amix.create(
+        fixture, output, True, name=test_name, cache_dir=cache_dir, transport="pipe"
+    ).run()
+    with open(os.path.join(output, test_name + ".wav"), "rb") as f:
+        assert hashlib.sha1(f.read()).hexdigest() == hashes[0]
+
+    # hoisted filters are applied once per clip, and batches render parts and
+    # segments only once
+    output = os.path.join(output, "transport_pipe_hoist")
+    definition = os.path.join(output, "amix.yml")
+    trace = os.path.join(output, "trace.json")
+    os.makedirs(output, exist_ok=True)
+    with open(fixture) as f:
+        data = yaml.safe_load(f)
+    data["filters"][0]["hoist"] = True
+    with open(definition, "w") as f:
+        yaml.dump(data, f)
+    clips = [os.path.join(os.path.dirname(fixture), "clips")]
+    commands = []
+    for names in [["single"], ["first", "second"]]:
+        batch = Batch(output, trace=trace)
+        for name in names:
+            batch.create(
+                definition,
+                yes=True,
+                clip=clips,
+                name=name,
+                cache=False,
+                transport="pipe",
+            )
+        batch.run()
+        with open(trace) as f:
+            events = json.load(f)["traceEvents"]
+        commands.append(
+            [e["args"]["cmd"] for e in events if e.get("cat") == "subprocess"]
+        )
+        assert len([c for c in commands[-1] if "rubberband" in c]) == 1
+    # only the mix is rendered again
+    assert len([c for c in commands[1] if c.startswith("ffmpeg ")]) == (
+        len([c for c in commands[0] if c.startswith("ffmpeg ")]) + 1
+    )
+    Amix.create(definition, output, True, clip=clips, name="file", cache=False).run()
+    hashes = []
+    for name in ["file", "single", "second"]:
+        with open(os.path.join(output, name + ".wav"), "rb") as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+    assert hashes[0] == hashes[1] == hashes[2]
+
+    with pytest.raises(Exception, match='Transport "pipe" does not support arun'):
+        asyncio.run(
+            Amix.create(fixture, output, True, name=test_name, transport="pipe").arun()
+        )
+
+
+def test_run_copy_mix():
+    """Test Amix().run joining the mix segments by stream copy"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "copy_mix")
+    trace = os.path.join(output, "trace.json")
+    hashes = []
+    for transport in ["file", "pipe"]:
+        Amix.create(
+            fixture, output, True, cache=False, transport=transport, trace=trace
+        ).run()
+        with open(trace) as f:
+            events = json.load(f)["traceEvents"]
+        commands = [e["args"]["cmd"] for e in events if e.get("cat") == "subprocess"]
+        assert "-f concat" in commands[-1]
+        assert "-acodec copy" in commands[-1]
+        with open(os.path.join(output, "Advanced.wav"), "rb") as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+
+    # like joining them with the concat filter
+    a = Amix.create(fixture, output, True, cache=False)
+    a._setup()
+    a._create_mix()
+    a._run([a._mix_output()])
+    with open(os.path.join(output, "Advanced.wav"), "rb") as f:
+        hashes.append(hashlib.sha1(f.read()).hexdigest())
+    assert len(set(hashes)) == 1
+
+
+def test_run_format(capfdbinary):
+    """Test Amix().run with output format and stdout"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "basic.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    test_name = "format"
+
+    Amix.create(fixture, output, True, name=test_name, format="flac").run()
+    with open(os.path.join(output, test_name + ".flac"), "rb") as f:
+        assert f.read(4) == b"fLaC"
+
+    Amix.create(
+        fixture, output, True, name=test_name, format="ogg", codec="libvorbis"
+    ).run()
+    with open(os.path.join(output, test_name + ".ogg"), "rb") as f:
+        assert f.read(4) == b"OggS"
+
+    capfdbinary.readouterr()
+    Amix.create(fixture, output, True, name=test_name, stdout=True).run()
+    assert capfdbinary.readouterr().out[:4] == b"RIFF"
+
+
+def test_run_preview():
+    """Test Amix().run rendering a preview"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    test_name = "preview"
+
+    Amix.create(fixture, output, True, name=test_name, cache=False).run()
+    with wave.open(os.path.join(output, test_name + ".wav")) as w:
+        duration = w.getnframes() / w.getframerate()
+
+    for engine in ["ffmpeg", "numpy"]:
+        a = Amix.create(
+            fixture, output, True, name=test_name, preview=True, engine=engine
+        )
+        a.run()
+        assert a.graph["filters"]["pitch_down"][1]["pitchq"] == "speed"
+        probe = ffmpeg.probe(os.path.join(output, test_name + ".mp3"))
+        stream = probe["streams"][0]
+        assert stream["codec_name"] == "mp3"
+        assert int(stream["sample_rate"]) == 22050
+        assert stream["channels"] == 1
+        # the timing of the mix is kept, up to the padding of mp3 frames
+        assert abs(float(probe["format"]["duration"]) - duration) < 0.1
+
+
+def test_run_window():
+    """Test Amix().run rendering a window of bars or segments"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+
+    def frames(test_name):
+        with wave.open(os.path.join(output, test_name + ".wav")) as w:
+            return w.readframes(w.getnframes()), w.getsampwidth() * w.getnchannels()
+
+    # 14 bars at 180 bpm and 44.1 kHz are 823200 frames
+    for engine in ["numpy", "ffmpeg"]:
+        Amix.create(
+            fixture, output, True, name="window_full", cache=False, engine=engine
+        ).run()
+        full, size = frames("window_full")
+        a = Amix.create(
+            fixture, output, True, name="window", bars=(14, 50), engine=engine
+        )
+        a.run()
+        assert [track["name"] for track in a.definition["mix"]] == [
+            "segment0",
+            "segment1",
+        ]
+        assert "backbeat0@14-32" in [p["name"] for p in a.graph["parts"]]
+        window, _ = frames("window")
+        assert len(window) == 36 * 58800 * size
+        assert window == full[823200 * size : 823200 * size + len(window)]
+
+    Amix.create(fixture, output, True, name="window", segments=["segment1"]).run()
+    window, _ = frames("window")
+    assert window == full[32 * 58800 * size : 32 * 58800 * size + len(window)]
+
+    with pytest.raises(Exception, match='Segment "segment3" does not exist'):
+        Amix.create(fixture, output, True, name="window", segments=["segment3"]).run()
+
+
+def test_run_trace():
+    """Test Amix().run with a trace"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "basic.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    trace = os.path.join(output, "trace.json")
+
+    Amix.create(fixture, output, True, name="trace", cache=False, trace=trace).run()
+    with open(trace) as f:
+        events = [e for e in json.load(f)["traceEvents"] if e["ph"] == "X"]
+    names = [e["name"] for e in events]
+    for name in ["load config", "validate schema", "setup", "render mix"]:
+        assert name in names
+    assert "clip backbeat" in names
+    assert len([e for e in events if e["cat"] == "part"]) > 0
+    assert len([e for e in events if e["cat"] == "segment"]) > 0
+    commands = [e["args"]["cmd"] for e in events if e.get("cat") == "subprocess"]
+    assert len([c for c in commands if c.startswith("ffprobe ")]) > 0
+    assert len([c for c in commands if c.startswith("ffmpeg ")]) > 0
+
+
+def test_run_batch():
+    """Test Batch().run sharing clips and renders between mixes"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "basic.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "batch")
+    trace = os.path.join(os.path.dirname(__file__), "tmp", "batch.json")
+
+    batch = Batch(output, jobs=2, trace=trace)
+    for name in ["first", "second"]:
+        batch.create(fixture, yes=True, name=name, cache=False)
+    batch.run()
+
+    hashes = []
+    for name in ["first", "second"]:
+        with open(os.path.join(output, name + ".wav"), "rb") as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+    assert hashes[0] == hashes[1]
+    assert not os.path.exists(batch.tmp_dir)
+
+    # the clip is decoded, and the part and segment are rendered only once
+    with open(trace) as f:
+        events = json.load(f)["traceEvents"]
+    assert len([e for e in events if e["name"] == "ffmpeg"]) == 5
+
+    assert data_matrix(["bars=8,16", "pitch=1"]) == [
+        ["bars=8", "pitch=1"],
+        ["bars=16", "pitch=1"],
+    ]
+
+
+def test_run_batch_probe_jobs():
+    """Test Batch().run bounding clip probes by its jobs"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "batch_probe")
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def probe(file):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.2)
+        with lock:
+            running[0] -= 1
+        return ffmpeg_probe(file)
+
+    ffmpeg_probe = ffmpeg.probe
+    batch = Batch(output, jobs=1)
+    batch.create(fixture, yes=True, jobs=2, cache=False)
+    with mock.patch("ffmpeg.probe", probe):
+        batch.run()
+    assert running[1] == 1
+
+
+def test_run_watch():
+    """Test Watch().run rendering only changed segments again"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "filter_segment.yml")
+    clips = os.path.join(os.path.dirname(__file__), "fixtures", "clips")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "watch")
+    definition = os.path.join(output, "amix.yml")
+    trace = os.path.join(output, "trace.json")
+    os.makedirs(output, exist_ok=True)
+    shutil.copyfile(fixture, definition)
+
+    def change(files):
+        with open(definition) as f:
+            data = yaml.safe_load(f)
+        if data["filters"][0]["curve"] == "qsin":
+            raise KeyboardInterrupt()
+        data["filters"][0]["curve"] = "qsin"
+        with open(definition, "w") as f:
+            yaml.dump(data, f)
+
+    watch = Watch(output, trace=trace)
+    watch.create(definition, yes=True, clip=[clips], cache=False)
+    with mock.patch.object(Watch, "_wait", side_effect=change):
+        watch.run()
+
+    # clips and parts are kept, only the segment and the mix are rendered again
+    with open(trace) as f:
+        events = json.load(f)["traceEvents"]
+    assert len([e for e in events if e["name"] == "ffmpeg"]) == 8
+    assert os.path.exists(os.path.join(output, "FiltersSegment.wav"))
+
+
+def test_arun():
+    """Test Amix().arun with asyncio and cancellation"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    test_name = "arun"
+
+    trace = os.path.join(output, "arun.json")
+    asyncio.run(
+        Amix.create(
+            fixture, output, True, name=test_name, jobs=2, cache=False, trace=trace
+        ).arun()
+    )
+    with open(trace) as f:
+        events = [e for e in json.load(f)["traceEvents"] if e["ph"] == "X"]
+    # spans of concurrent tasks are on their own threads, where they nest
+    for tid in set([e["tid"] for e in events]):
+        stack = []
+        for e in sorted(
+            [e for e in events if e["tid"] == tid], key=lambda e: (e["ts"], -e["dur"])
+        ):
+            while len(stack) > 0 and stack[-1] <= e["ts"]:
+                stack.pop()
+            assert len(stack) == 0 or e["ts"] + e["dur"] <= stack[-1] + 1
+            stack.append(e["ts"] + e["dur"])
+    assert len(set([e["tid"] for e in events if e["cat"] == "part"])) > 1
+
+    a = Amix.create(fixture, output, True, name=test_name + "_sync", cache=False)
+    a.run()
+    hashes = []
+    for name in [test_name, test_name + "_sync"]:
+        with open(os.path.join(output, name + ".wav"), "rb") as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+    assert hashes[0] == hashes[1]
+
+    processes = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def spawn(*args, **kwargs):
+        processes.append(await create_subprocess_exec(*args, **kwargs))
+        return processes[-1]
+
+    async def cancel():
+        a = Amix.create(fixture, output, True, name=test_name, cache=False, jobs=2)
+        task = asyncio.ensure_future(a.arun())
+        while len([p for p in processes if p.returncode == None]) == 0:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with mock.patch("asyncio.create_subprocess_exec", spawn):
+        asyncio.run(cancel())
+    assert all([p.returncode != None for p in processes])
+    assert not os.path.exists(os.path.join(output, test_name, "tmp"))
+
+
+def test_run_numpy_engine():
+    """Test Amix().run with the NumPy engine"""
+    np = pytest.importorskip("numpy")
+    fixtures = glob.glob(os.path.join(os.path.dirname(__file__), "fixtures", "*.yml"))
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+
+    def read(filename):
+        with wave.open(filename) as f:
+            return np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16) / 32768
+
+    for fixture in fixtures:
+        test_name = os.path.splitext(os.path.basename(fixture))[0]
+        samples = []
+        for engine in ["ffmpeg", "numpy"]:
+            Amix.create(
+                fixture, output, True, name=test_name + engine, engine=engine
+            ).run()
+            samples.append(read(os.path.join(output, test_name + engine + ".wav")))
+
+        assert len(samples[0]) == len(samples[1])
+        rms = np.sqrt(np.mean((samples[0] - samples[1]) ** 2))
+        assert rms <= 0.1 * np.sqrt(np.mean(samples[0] ** 2))
+
+
+def test_run_numpy_engine_nofade():
+    """Test Amix().run with the NumPy engine fading out without a curve"""
+    np = pytest.importorskip("numpy")
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "fade_filter.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "numpy_nofade")
+    definition = os.path.join(output, "amix.yml")
+    os.makedirs(output, exist_ok=True)
+    with open(fixture) as f:
+        data = yaml.safe_load(f)
+    data["filters"][0].update(curve="nofade", direction="out", start_time=1, duration=4)
+    with open(definition, "w") as f:
+        yaml.dump(data, f)
+
+    def read(filename):
+        with wave.open(filename) as f:
+            return np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16) / 32768
+
+    samples = []
+    for engine in ["ffmpeg", "numpy"]:
+        Amix.create(
+            definition,
+            output,
+            True,
+            clip=[os.path.join(os.path.dirname(fixture), "clips")],
+            name=engine,
+            engine=engine,
+            cache=False,
+        ).run()
+        samples.append(read(os.path.join(output, engine + ".wav")))
+
+    assert len(samples[0]) == len(samples[1])
+    # the fade out ends at bar 5, afade applies nofade per frame up to then
+    end = len(samples[0]) * 5 // 16
+    frame = 2 * 4096
+    assert np.array_equal(samples[0][:end], samples[1][:end])
+    assert np.max(np.abs(samples[0][end + frame :])) == 0
+    assert np.max(np.abs(samples[1][end:])) == 0
+
+
+def test_run_numpy_engine_pcm():
+    """Test Amix().run with the NumPy engine memory mapping clips"""
+    np = pytest.importorskip("numpy")
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    test_name = "numpy_pcm"
+    tmp_dir = os.path.join(output, test_name, "tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    a = Amix.create(
+        fixture, output, True, name=test_name, keep_tempfiles=True, engine="numpy"
+    )
+    a.run()
+    assert len([f for f in os.listdir(tmp_dir) if f.endswith(".f32")]) == 2
+    for clip in a.clips.values():
+        assert isinstance(clip.samples, np.memmap)
+        assert not clip.samples.flags.writeable
+
+
+def test_run_cache():
+    """Test Amix().run with render cache"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    cache_dir = os.path.join(output, "render_cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    hashes = []
+    tmp_files = []
+    test_name = "cache"
+    for cache in [False, True, True]:
+        Amix.create(
+            fixture,
+            output,
+            True,
+            name=test_name,
+            keep_tempfiles=True,
+            cache=cache,
+            cache_dir=cache_dir,
+        ).run()
+        hashes.append(
+            hashlib.sha1(
+                open(os.path.join(output, test_name + ".wav"), "rb").read()
+            ).hexdigest()
+        )
+        tmp_files.append(os.listdir(os.path.join(output, test_name, "tmp")))
+        shutil.rmtree(os.path.join(output, test_name, "tmp"))
+
+    assert hashes[0] == hashes[1] == hashes[2]
+    assert len(tmp_files[1]) > 0 and len(tmp_files[2]) == 0
+    assert len(os.listdir(os.path.join(cache_dir, "render"))) == 8
+
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "basic.yml")
+    Amix.create(
+        fixture, output, True, name=test_name, cache_dir=cache_dir, cache_size=0
+    ).run()
+    assert len(os.listdir(os.path.join(cache_dir, "render"))) == 0
+
+
+def test_load_clips_probe_cache():
+    """Test Amix()._load_clips with probe cache"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "basic.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    cache_dir = os.path.join(output, "probe_cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    a = Amix.create(fixture, output, True, cache_dir=cache_dir)
+    a._load_clips()
+    probes = {k: v.probe for k, v in a.clips.items()}
+    assert os.path.exists(os.path.join(cache_dir, "probes.json"))
+
+    a = Amix.create(fixture, output, True, cache_dir=cache_dir)
+    with mock.patch("ffmpeg.probe", side_effect=Exception("probed")):
+        a._load_clips()
+    assert {k: v.probe for k, v in a.clips.items()} == probes
+
+    # only backbeat is used by the mix
+    clip = a.clips["backbeat"].path
+    stat = os.stat(clip)
+    os.utime(clip, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    try:
+        with mock.patch("ffmpeg.probe", side_effect=Exception("probed")):
+            with pytest.raises(Exception, match="probed"):
+                a._load_clips()
+    finally:
+        os.utime(clip, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def test_load_clips_order():
+    """Test Amix()._load_clips keeps the order of clips"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "filter_segment.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    clips_dir = os.path.join(os.path.dirname(__file__), "fixtures", "clips")
+    a = Amix.create(fixture, output, True, clip=[clips_dir], cache=False, jobs=4)
+    a._load_clips()
+    assert list(a.clips.keys()) == [c["name"] for c in a.definition["clips"]]
+
+    a.definition["clips"][1]["path"] = os.path.join(clips_dir, "test.wav")
+    with pytest.raises(Exception):
+        a._load_clips()
+
+
+def test_discover_clips():
+    """Test discover keeping the order of sorted globs"""
+    output = os.path.join(os.path.dirname(__file__), "tmp", "library")
+    cache_dir = os.path.join(output, "cache")
+    clips_dir = os.path.join(output, "clips")
+    shutil.rmtree(output, ignore_errors=True)
+    os.makedirs(os.path.join(clips_dir, "drums"))
+    files = ["b.wav", "a.mp3", "c.aif", "d.wav", ".hidden.wav", "notes.txt"]
+    files += [os.path.join("drums", "kick.wav")]
+    for i, file in enumerate(files):
+        open(os.path.join(clips_dir, file), "w").close()
+        os.utime(os.path.join(clips_dir, file), (i, 10 - i))
+
+    globs = []
+    for t in ("*.mp3", "*.wav", "*.aif"):
+        globs += sorted(glob.glob(os.path.join(clips_dir, t)), key=os.path.getmtime)
+    assert discover(clips_dir) == globs
+    assert discover(clips_dir, recursive=True) == [
+        os.path.join(clips_dir, f)
+        for f in ["a.mp3", os.path.join("drums", "kick.wav"), "d.wav", "b.wav", "c.aif"]
+    ]
+
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "basic.yml")
+    Amix.create(fixture, output, clip=[clips_dir], cache_dir=cache_dir, index=True)
+    # unchanged folders are listed from the index
+    with mock.patch("os.scandir", side_effect=Exception("scanned")):
+        a = Amix.create(
+            fixture, output, clip=[clips_dir], cache_dir=cache_dir, index=True
+        )
+    assert [c["path"] for c in a.definition["clips"]] == [
+        os.path.relpath(f) for f in globs
+    ]
+    # files overwritten in place keep the mtime of their folder
+    folder = os.stat(clips_dir)
+    with open(os.path.join(clips_dir, "d.wav"), "w") as f:
+        f.write("new")
+    os.utime(clips_dir, ns=(folder.st_atime_ns, folder.st_mtime_ns))
+    with mock.patch("os.scandir", side_effect=Exception("scanned")):
+        a = Amix.create(
+            fixture, output, clip=[clips_dir], cache_dir=cache_dir, index=True
+        )
+    assert [os.path.basename(c["path"]) for c in a.definition["clips"]] == [
+        "a.mp3",
+        "b.wav",
+        "d.wav",
+        "c.aif",
+    ]
+
+    # watches see clips in sub folders of recursively discovered folders
+    watch = Watch(output)
+    watch.create(fixture, clip=[clips_dir], recursive=True)
+    assert os.path.join(clips_dir, "drums", "kick.wav") in watch._files()
+    assert os.path.join(clips_dir, "drums") in watch._files()
+
+    with pytest.raises(Exception, match="can only be indexed with the cache"):
+        Amix.create(fixture, output, clip=[clips_dir], cache=False, index=True)
+
+    open(os.path.join(clips_dir, "e.mp3"), "w").close()
+    with mock.patch("os.scandir", side_effect=Exception("scanned")):
+        with pytest.raises(Exception, match="scanned"):
+            Amix.create(
+                fixture, output, clip=[clips_dir], cache_dir=cache_dir, index=True
+            )
+
+
+def test_run_reachable_parts():
+    """Test Amix().run only rendering parts used by the mix"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "basic.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+    test_name = "reachable_parts"
+
+    a = Amix.create(fixture, output, True, name=test_name, parts_from_clips=True)
+    a.run()
+    assert [c["name"] for c in a.graph["clips"]] == ["backbeat"]
+    assert "bass" not in [p["name"] for p in a.graph["parts"]]
+    assert not os.path.exists(os.path.join(output, test_name, "parts", "bass.wav"))
+
+    a.definition["mix"][0]["parts"].append({"name": "missing"})
+    a.definition["parts"][0]["clips"].append({"name": "missing"})
+    with pytest.raises(Exception, match='Part "missing" of segment "segment"'):
+        a._graph()
+
+
+def test_load_clips_filters():
+    """Test Amix()._load_clips compiling filters"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "filter_part.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp")
+
+    a = Amix.create(fixture, output, True, cache=False)
+    a._load_clips()
+    assert list(a.graph["filters"].keys()) == ["fade_in"]
+    chain = a.definition["parts"][0]["filters"]
+    assert a._resolve_filters(chain) is a._resolve_filters(list(chain))
+
+    a.definition["parts"][0]["clips"][0]["filters"] = [{"name": "missing"}]
+    with pytest.raises(Exception, match='Filter "missing" of clip "backbeat"'):
+        a._load_clips()
+
+
+def test_run_hoist():
+    """Test Amix().run applying a pitch filter once to the source clip"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    clips = os.path.join(os.path.dirname(__file__), "fixtures", "clips")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "hoist")
+    definition = os.path.join(output, "amix.yml")
+    trace = os.path.join(output, "trace.json")
+    os.makedirs(output, exist_ok=True)
+    with open(fixture) as f:
+        data = yaml.safe_load(f)
+    data["filters"][0]["hoist"] = True
+    with open(definition, "w") as f:
+        yaml.dump(data, f)
+
+    Amix.create(definition, output, True, clip=[clips], cache=False, trace=trace).run()
+    # the pitch filter of both backbeat parts is applied once to the clip
+    with open(trace) as f:
+        events = json.load(f)["traceEvents"]
+    commands = [e["args"]["cmd"] for e in events if e.get("cat") == "subprocess"]
+    assert len([c for c in commands if "rubberband" in c]) == 1
+    assert os.path.exists(os.path.join(output, "Advanced.wav"))
+
+    # a preview with the rubberband settings of previews doesn't share its
+    # hoisted clip with full renders
+    cache_dir = os.path.join(output, "cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    data["filters"][0].update(transients="smooth", window="short", pitchq="speed")
+    with open(definition, "w") as f:
+        yaml.dump(data, f)
+    for preview in [True, False]:
+        Amix.create(
+            definition,
+            output,
+            True,
+            clip=[clips],
+            cache_dir=cache_dir,
+            preview=preview,
+            format="wav",
+        ).run()
+    with wave.open(os.path.join(output, "Advanced.wav")) as w:
+        assert w.getframerate() == 44100
+        assert w.getnchannels() == 2
+
+    # neither do batches sharing the hoisted samples of clips in the numpy engine
+    batch = Batch(output)
+    for name, preview in [("preview", True), ("full", False)]:
+        batch.create(
+            definition,
+            yes=True,
+            clip=[clips],
+            name=name,
+            cache=False,
+            preview=preview,
+            engine="numpy",
+        )
+    batch.run()
+    Amix.create(
+        definition, output, True, clip=[clips], name="single", engine="numpy"
+    ).run()
+    hashes = []
+    for name in ["full", "single"]:
+        with open(os.path.join(output, name + ".wav"), "rb") as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+    assert hashes[0] == hashes[1]
+
+    data["filters"][1]["hoist"] = True
+    with open(definition, "w") as f:
+        yaml.dump(data, f)
+    with pytest.raises(Exception, match='Filter "volume_cut" can not be hoisted'):
+        Amix.create(definition, output, True, clip=[clips], cache=False).run()
+
+
+def test_run_optimize():
+    """Test Amix().run optimizing filters and parts sharing their clips"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "optimize")
+    definition = os.path.join(output, "amix.yml")
+    trace = os.path.join(output, "trace.json")
+    os.makedirs(output, exist_ok=True)
+    with open(fixture) as f:
+        data = yaml.safe_load(f)
+    data["filters"] += [
+        {"name": "half", "type": "volume", "volume": 0.5},
+        {"name": "unity", "type": "volume", "volume": 1},
+        {"name": "same_pitch", "type": "pitch"},
+    ]
+    data["parts"][3]["filters"] = [
+        {"name": "half"},
+        {"name": "unity"},
+        {"name": "half"},
+        {"name": "same_pitch"},
+    ]
+    with open(definition, "w") as f:
+        yaml.dump(data, f)
+
+    hashes = []
+    for optimize in [True, False]:
+        if not optimize:
+            # renders like the optimized chain without optimizing
+            data["filters"].append(
+                {"name": "quarter", "type": "volume", "volume": 0.25}
+            )
+            data["parts"][3]["filters"] = [{"name": "quarter"}]
+            with open(definition, "w") as f:
+                yaml.dump(data, f)
+        a = Amix.create(
+            definition,
+            output,
+            True,
+            clip=[os.path.join(os.path.dirname(fixture), "clips")],
+            cache=False,
+            optimize=optimize,
+            trace=trace,
+        )
+        a.run()
+        with open(os.path.join(output, "Advanced.wav"), "rb") as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+        with open(trace) as f:
+            events = json.load(f)["traceEvents"]
+        commands = [e["args"]["cmd"] for e in events if e.get("cat") == "subprocess"]
+        rubberbands = [c.count("rubberband=") for c in commands if "rubberband=" in c]
+        if optimize:
+            assert a._resolve_filters(
+                [{"name": "half"}, {"name": "unity"}, {"name": "half"}]
+            ) == [("volume", {"volume": 0.25})]
+            assert a._resolve_filters([{"name": "same_pitch"}]) == []
+            # backbeat0 and backbeat1 share their clip and pitch filter
+            assert rubberbands == [1]
+        else:
+            assert rubberbands == [1, 1]
+    assert hashes[0] == hashes[1]
+
+
+def test_run_optimize_shared_clip():
+    """Test Amix().run optimizing parts sharing a clip with the same filters"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "advanced.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "optimize_shared_clip")
+    definition = os.path.join(output, "amix.yml")
+    trace = os.path.join(output, "trace.json")
+    os.makedirs(output, exist_ok=True)
+    with open(fixture) as f:
+        data = yaml.safe_load(f)
+    backbeat = {"name": "backbeat", "loop": 2, "filters": [{"name": "pitch_down"}]}
+    data["parts"] = [
+        {"name": "drums", "clips": [backbeat]},
+        {"name": "groove", "clips": [backbeat, {"name": "bass", "offset": 16}]},
+    ]
+    data["mix"] = [
+        {"name": "segment0", "parts": [{"name": "drums"}]},
+        {"name": "segment1", "parts": [{"name": "groove"}]},
+    ]
+    with open(definition, "w") as f:
+        yaml.dump(data, f)
+
+    hashes = []
+    for optimize in [False, True]:
+        Amix.create(
+            definition,
+            output,
+            True,
+            clip=[os.path.join(os.path.dirname(fixture), "clips")],
+            cache=False,
+            optimize=optimize,
+            trace=trace,
+        ).run()
+        with open(os.path.join(output, "Advanced.wav"), "rb") as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+        with open(trace) as f:
+            events = json.load(f)["traceEvents"]
+        commands = [e["args"]["cmd"] for e in events if e.get("cat") == "subprocess"]
+        rubberbands = [c.count("rubberband=") for c in commands if "rubberband=" in c]
+        # the pitch shifted backbeat is rendered once for both parts
+        assert rubberbands == ([1] if optimize else [1, 1])
+    assert hashes[0] == hashes[1]
+
+
+def test_run_optimize_fade():
+    """Test Amix().run optimizing fades without a curve"""
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "fade_filter.yml")
+    output = os.path.join(os.path.dirname(__file__), "tmp", "optimize_fade")
+    definition = os.path.join(output, "amix.yml")
+    os.makedirs(output, exist_ok=True)
+    with open(fixture) as f:
+        data = yaml.safe_load(f)
+    data["filters"][0].update(curve="nofade", direction="out", start_time=1, duration=4)
+    data["filters"].append(
+        {"name": "no_fade", "type": "fade", "curve": "nofade", "direction": "in"}
+    )
+    data["parts"][0]["clips"][0]["filters"].append({"name": "no_fade"})
+    with open(definition, "w") as f:
+        yaml.dump(data, f)
+
+    hashes = []
+    for optimize in [False, True]:
+        a = Amix.create(
+            definition,
+            output,
+            True,
+            clip=[os.path.join(os.path.dirname(fixture), "clips")],
+            cache=False,
+            optimize=optimize,
+        )
+        a.run()
+        with open(os.path.join(output, "Fade Filter.wav"), "rb") as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+    # the fade out still silences the part after it ends, only the fade in is dropped
+    assert hashes[0] == hashes[1]
+    assert [
+        t for t, _ in a._resolve_filters(data["parts"][0]["clips"][0]["filters"])
+    ] == ["afade"]
+
+
 def test_run_wrong_filter():
     """Test Amix().run wrong filter"""
     fixture = os.path.join(os.path.dirname(__file__), "fixtures", "fade_filter.yml")
@@ -67,6 +973,12 @@ def test_run_wrong_filter():
     with pytest.raises(Exception):
         a.run()
 
+    a = Amix.create(fixture, output, True, name=test_name, jobs=2)
+    a.definition["filters"][0]["type"] = test_name
+
+    with pytest.raises(Exception):
+        a.run()
+
 
 def test_create(snapshot):
     """Test Amix.create"""
@@ -13,6 +13,27 @@ __copyright__ = "Sebastian Krüger"
 __license__ = "MIT"
 
 
+def test_validate(capsys):
+    """Test CLI().run validate"""
+    fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+    clips_dir = os.path.join(fixtures_dir, "clips")
+
+    sys.argv = ["test", "validate", os.path.join(fixtures_dir, "basic.yml")]
+    sys.argv += ["-c", clips_dir]
+    run()
+    assert "is valid" in capsys.readouterr().out
+
+    sys.argv = [
+        "test",
+        "validate",
+        os.path.join(fixtures_dir, "templates", "data.yml.j2"),
+    ]
+    sys.argv += ["-c", clips_dir, "-d", "bars='8'"]
+    with pytest.raises(SystemExit):
+        run()
+    assert "is invalid" in capsys.readouterr().out
+
+
 def test_run(snapshot):
     """Test CLI().run"""
     snapshots_dir = os.path.join(os.path.dirname(__file__), "snapshots", "cli")